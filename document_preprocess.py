@@ -1,14 +1,20 @@
 import os
+import sys
 import json
 import pdfplumber
 from pathlib import Path
 from pydantic import BaseModel
-from typing import List, Any
+from typing import List, Any, Set, Dict, Tuple
 from datetime import datetime
+from collections import OrderedDict
 
 import htmltabletomd
 import pymupdf4llm
 
+sys.path.append(str(Path(__file__).resolve().parent / "preprocess_document" / "src"))
+from words_format import find_words_file, load_words
+from artifact_container import CONTAINER_SUFFIX, ContainerReader
+
 """ 
     Handle the results generated through preprocess_document
 
@@ -49,14 +55,100 @@ def adjust_coordinates_for_dpi(bbox, pdf_width, pdf_height, dpi=300):
     adjusted_bbox = (bbox[0] / scale_x, bbox[1] / scale_y, bbox[2] / scale_x, bbox[3] / scale_y)
     return adjusted_bbox
 
+def adjust_coordinates_for_scale(bbox, scale):
+    """Convert bbox coordinates from image pixels to PDF points; scale is (x, y) pixels per point."""
+    return (bbox[0] / scale[0], bbox[1] / scale[1], bbox[2] / scale[0], bbox[3] / scale[1])
+
+# open artifact container readers by path, least recently used first
+container_readers = OrderedDict()
+
+def get_container_reader(container_path: Path, max_open: int = 8):
+    """Open the artifact container (written by inference.py --artifact_container) once per document."""
+    if container_path in container_readers:
+        container_readers.move_to_end(container_path)
+        return container_readers[container_path]
+    if not container_path.exists():
+        return None
+    if len(container_readers) >= max_open:
+        _, oldest = container_readers.popitem(last=False)
+        oldest.close()
+    container_readers[container_path] = ContainerReader(str(container_path))
+    return container_readers[container_path]
+
+def close_container_readers():
+    """Close the container readers opened by get_container_reader."""
+    for reader in container_readers.values():
+        reader.close()
+    container_readers.clear()
+
+def load_container_artifact(folder: Path, file_name: str, file_prefix: str):
+    """Read an output file from the document's artifact container in the parent of folder, if there is one."""
+    container = get_container_reader(folder.parent / f"{file_prefix}{CONTAINER_SUFFIX}")
+    key = f"{folder.name}/{file_name}"
+    if container is None or key not in container:
+        return None
+    return container.get_text(key)
+
 def load_page_objects(page_number, detection_folder, file_prefix):
     """Load JSON data for a specific page."""
     json_path = detection_folder / f"{file_prefix}_page{page_number}_objects.json"
     if json_path.exists():
         with open(json_path, 'r') as file:
             return json.load(file)
+    content = load_container_artifact(detection_folder, json_path.name, file_prefix)
+    if content is not None:
+        return json.loads(content)
     return []
 
+def load_page_words(page_number, words_folder, file_prefix):
+    """Load the words of a specific page written by convert_pdf_to_image.py (binary or JSON words file)."""
+    words_path = find_words_file(words_folder, f"{file_prefix}_page{page_number}")
+    if words_path is None:
+        return []
+    return load_words(words_path)
+
+def get_words_text_lines(words, scale, y_tolerance=3):
+    """
+    Group words (image pixel coordinates, scale (x, y) pixels per point) into text lines like pdfplumber's
+    extract_text_lines: words whose tops are within y_tolerance points form one line, read left to right.
+    Coordinates are in PDF points.
+    """
+    boxes = [(adjust_coordinates_for_scale(word['bbox'], scale), word['text'])
+             for word in words if word['text'].strip()]
+    clusters = []
+    for bbox, text in sorted(boxes, key=lambda box: box[0][1]):
+        if clusters and bbox[1] - clusters[-1][0][0][1] <= y_tolerance:
+            clusters[-1].append((bbox, text))
+        else:
+            clusters.append([(bbox, text)])
+    text_lines = []
+    for cluster in clusters:
+        cluster.sort(key=lambda box: box[0][0])
+        text_lines.append({'text': ' '.join(text for _, text in cluster),
+                           'x0': min(bbox[0] for bbox, _ in cluster), 'top': min(bbox[1] for bbox, _ in cluster),
+                           'x1': max(bbox[2] for bbox, _ in cluster), 'bottom': max(bbox[3] for bbox, _ in cluster)})
+    return text_lines
+
+def load_render_scales(render_scales_path, file_prefix):
+    """
+    Load the render scale (x, y image pixels per PDF point) of every page convert_pdf_to_image.py rendered
+    for a PDF. Pages rendered with --max_size are not at a fixed dpi.
+    """
+    render_scales_path = Path(render_scales_path)
+    if render_scales_path.exists():
+        with open(render_scales_path, 'r', encoding='utf-8') as file:
+            scales = json.load(file).get(file_prefix, {})
+            return {int(page_number): tuple(scale) for page_number, scale in scales.items()}
+    return {}
+
+def load_skipped_pages(skipped_pages_path, file_prefix):
+    """Load the page numbers the table prescreen of convert_pdf_to_image.py skipped for a PDF."""
+    skipped_pages_path = Path(skipped_pages_path)
+    if skipped_pages_path.exists():
+        with open(skipped_pages_path, 'r', encoding='utf-8') as file:
+            return set(json.load(file).get(file_prefix, []))
+    return set()
+
 def is_within_bbox(word_bbox, table_bbox):
     """Check if the word's bounding box is within the table's bounding box."""
     word_x0, word_top, word_x1, word_bottom = word_bbox
@@ -64,7 +156,9 @@ def is_within_bbox(word_bbox, table_bbox):
     return (word_x0 >= table_x0 and word_x1 <= table_x1 and
             word_top >= table_top and word_bottom <= table_bottom)
 
-def process_pdf_text_from_plumber(pdf_path: str, detection_folder: Path, file_prefix: str, dpi: int = 300) -> List[TextElement]:
+def process_pdf_text_from_plumber(pdf_path: str, detection_folder: Path, file_prefix: str, dpi: int = 300,
+                                  skipped_pages: Set[int] = None, words_folder: Path = None,
+                                  render_scales: Dict[int, Tuple[float, float]] = None) -> List[TextElement]:
     """
     Process a PDF file and extract text elements.
 
@@ -72,24 +166,39 @@ def process_pdf_text_from_plumber(pdf_path: str, detection_folder: Path, file_pr
     pdf_path (str): The path to the PDF file.
     detection_folder (Path): The folder containing the detection data.
     file_prefix (str): The prefix for the detection files.
-    dpi (int, optional): The DPI to use for adjustment. Defaults to 300.
+    dpi (int, optional): The DPI to use for adjustment of pages without a render scale. Defaults to 300.
+    skipped_pages (Set[int], optional): Pages skipped by the table prescreen (see load_skipped_pages).
+        They have no detection data, and all of their text is extracted as text elements.
+    words_folder (Path, optional): The folder of the words files written by convert_pdf_to_image.py.
+        Text lines of pages with a words file are built from it instead of being extracted again by pdfplumber.
+    render_scales (Dict[int, Tuple[float, float]], optional): Image pixels per PDF point of each page
+        (see load_render_scales), used instead of dpi to map detections and words back to the PDF.
 
     Returns:
     List[TextElement]: A list of extracted text elements.
     """
     results = []
+    skipped_pages = skipped_pages or set()
+    render_scales = render_scales or {}
     with pdfplumber.open(pdf_path) as pdf:
         for page_number, page in enumerate(pdf.pages, start=1):  # 페이지 번호 1부터 시작
             objects = load_page_objects(page_number, detection_folder, file_prefix)
-            if not objects:
+            if not objects and page_number not in skipped_pages:
                 continue
             sorted_objects = sorted(objects, key=lambda x: x['bbox'][1])
-            tables = [adjust_coordinates_for_dpi(obj['bbox'], page.width, page.height, dpi) for obj in sorted_objects]
+            scale = render_scales.get(page_number, (dpi / 72, dpi / 72))
+            tables = [adjust_coordinates_for_scale(obj['bbox'], scale) for obj in sorted_objects]
             current_text = ""
             is_current_table = False
             table_index = 0  # 테이블 인덱스 1부터 시작
 
-            for line in page.extract_text_lines(return_chars=True):
+            words = load_page_words(page_number, words_folder, file_prefix) if words_folder is not None else []
+            if words:
+                text_lines = get_words_text_lines(words, scale)
+            else:
+                text_lines = page.extract_text_lines(return_chars=True)
+
+            for line in text_lines:
                 line_bbox = (line['x0'], line['top'], line['x1'], line['bottom'])
                 line_is_table = any(is_within_bbox(line_bbox, tbl) for tbl in tables)
 
@@ -120,6 +229,8 @@ def process_pdf_text_from_plumber(pdf_path: str, detection_folder: Path, file_pr
                     bbox=line_bbox  # Include bbox
                 ))
 
+    # no container reader stays open between documents
+    close_container_readers()
     return results
 
 def postprocess_with_datr(elements: List[TextElement], structure_path: Path, file_prefix: str):
@@ -130,7 +241,11 @@ def postprocess_with_datr(elements: List[TextElement], structure_path: Path, fil
             if html_path.exists():
                 with open(html_path, 'r', encoding='utf-8') as file:
                     html_content = file.read()
+            else:
+                html_content = load_container_artifact(structure_path, html_path.name, file_prefix)
+            if html_content is not None:
                 element.text = htmltabletomd.convert_table(html_content)
+    close_container_readers()
     return elements
 
 def get_mupdf4llm_markdown(pdf_path:str):
@@ -147,11 +262,17 @@ if __name__ == "__main__":
 
     detection_path = base_path / "results/detection"
     structure_path = base_path / "results/structure"
+    words_path = base_path / "words"
     
     # base_path의 마지막 디렉토리 이름과 pdf_path의 파일 이름(확장자를 제외한 부분)을 결합하여 file_prefix 생성
     file_prefix = f"{pdf_path.stem}"
 
-    pdfplumber_extracted_text = process_pdf_text_from_plumber(pdf_path, detection_path, file_prefix)
+    skipped_pages = load_skipped_pages(base_path / "skipped_pages.json", file_prefix)
+    render_scales = load_render_scales(base_path / "render_scales.json", file_prefix)
+
+    pdfplumber_extracted_text = process_pdf_text_from_plumber(pdf_path, detection_path, file_prefix,
+                                                              skipped_pages=skipped_pages, words_folder=words_path,
+                                                              render_scales=render_scales)
 
     # for element in pdfplumber_extracted_text:
     #     print(f"Type: {element.type}, Page: {element.page_number}, Table Index: {element.table_index}")
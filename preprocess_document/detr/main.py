@@ -55,6 +55,8 @@ def get_args_parser():
     parser.add_argument('--num_queries', default=100, type=int,
                         help="Number of query slots")
     parser.add_argument('--pre_norm', action='store_true')
+    parser.add_argument('--attention', default='multihead', type=str, choices=('multihead', 'sdpa'),
+                        help="Attention implementation: nn.MultiheadAttention or fused scaled dot product attention")
 
     # * Segmentation
     parser.add_argument('--masks', action='store_true',
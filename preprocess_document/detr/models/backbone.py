@@ -16,7 +16,7 @@ from typing import Dict, List
 # from detr.util.misc import NestedTensor, is_main_process
 from util.misc import NestedTensor, is_main_process
 
-from .position_encoding import build_position_encoding
+from .position_encoding import PositionEmbeddingSine, build_position_encoding
 
 
 class FrozenBatchNorm2d(torch.nn.Module):
@@ -58,6 +58,30 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+def fold_frozen_batchnorm(module: nn.Module):
+    """
+    Fold every FrozenBatchNorm2d that directly follows a Conv2d among the children of a module
+    (recursively) into the conv weight and bias, and replace it by nn.Identity.
+    Children are paired in registration order, which is their forward order in torchvision ResNets.
+    For inference only: the folded convs are no longer frozen BN + conv for training purposes.
+    """
+    children = list(module.named_children())
+    for (_, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, FrozenBatchNorm2d):
+            with torch.no_grad():
+                scale = bn.weight * (bn.running_var + 1e-5).rsqrt()
+                bias = bn.bias - bn.running_mean * scale
+                conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                if conv.bias is None:
+                    conv.bias = nn.Parameter(bias, requires_grad=False)
+                else:
+                    conv.bias.mul_(scale).add_(bias)
+            setattr(module, bn_name, nn.Identity())
+    for child in module.children():
+        fold_frozen_batchnorm(child)
+    return module
+
+
 class BackboneBase(nn.Module):
 
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
@@ -72,6 +96,17 @@ class BackboneBase(nn.Module):
         self.body = IntermediateLayerGetter(backbone, return_layers=return_layers)
         self.num_channels = num_channels
 
+    def keep_last_output(self):
+        """
+        Only return the last feature map, e.g. when intermediate layers were built for a mask head
+        that is not used at inference.
+        """
+        if not isinstance(self.body, IntermediateLayerGetter):
+            # e.g. a quantized graph module, already traced with its outputs
+            return
+        last_layer = list(self.body.return_layers)[-1]
+        self.body.return_layers = {last_layer: "0"}
+
     def forward(self, tensor_list: NestedTensor):
         xs = self.body(tensor_list.tensors)
         out: Dict[str, NestedTensor] = {}
@@ -121,10 +156,27 @@ class Joiner(nn.Sequential):
         for name, x in xs.items():
             out.append(x)
             # position encoding
-            pos.append(self[1](x).to(x.tensors.dtype))
+            if not torch.jit.is_scripting() and self.use_cached_position_encoding(x):
+                batch_size, _, h, w = x.tensors.shape
+                pos.append(self[1].forward_unmasked(h, w, x.tensors.device)
+                           .expand(batch_size, -1, -1, -1).to(x.tensors.dtype))
+            else:
+                pos.append(self[1](x).to(x.tensors.dtype))
 
         return out, pos
 
+    @torch.jit.unused
+    def use_cached_position_encoding(self, x: NestedTensor) -> bool:
+        """
+        At inference, the sine encoding of a batch without padding only depends on the feature map shape.
+        Graphs being traced or compiled compute it from the mask, so they stay valid for other shapes.
+        """
+        if self.training or not isinstance(self[1], PositionEmbeddingSine):
+            return False
+        if torch.jit.is_tracing() or torch.compiler.is_compiling():
+            return False
+        return not x.mask.any()
+
 
 def build_backbone(args):
     position_embedding = build_position_encoding(args)
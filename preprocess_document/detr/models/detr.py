@@ -15,7 +15,7 @@ from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate,
                        is_dist_avail_and_initialized)
 
-from .backbone import build_backbone
+from .backbone import build_backbone, fold_frozen_batchnorm
 from .matcher import build_matcher
 from .segmentation import (DETRsegm, PostProcessPanoptic, PostProcessSegm,
                            dice_loss, sigmoid_focal_loss)
@@ -44,6 +44,9 @@ class DETR(nn.Module):
         self.input_proj = nn.Conv2d(backbone.num_channels, hidden_dim, kernel_size=1)
         self.backbone = backbone
         self.aux_loss = aux_loss
+        # optional EarlyExit and TokenPruning policies for inference, see enable_early_exit/enable_token_pruning
+        self.early_exit = None
+        self.token_pruning = None
 
     def forward(self, samples: NestedTensor):
         """ The forward expects a NestedTensor, which consists of:
@@ -62,6 +65,8 @@ class DETR(nn.Module):
         """
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
+        if not torch.jit.is_scripting() and self.use_inference_policies():
+            return self.forward_inference(samples)
         features, pos = self.backbone(samples)
 
         src, mask = features[-1].decompose()
@@ -75,6 +80,47 @@ class DETR(nn.Module):
             out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord)
         return out
 
+    @torch.jit.unused
+    def use_inference_policies(self):
+        # graphs being traced or compiled always run every token through every decoder layer
+        if (self.early_exit is None and self.token_pruning is None) or self.training:
+            return False
+        return not (torch.jit.is_tracing() or torch.compiler.is_compiling())
+
+    @torch.jit.unused
+    def forward_inference(self, samples: NestedTensor):
+        """
+        Inference forward with the optional policies: self.token_pruning drops feature locations
+        from the transformer input, and with self.early_exit the prediction heads are applied after every
+        decoder layer, stopping as soon as the predictions of the whole batch have converged.
+        Returns the predictions of the last layer run.
+        """
+        features, pos = self.backbone(samples)
+
+        src, mask = features[-1].decompose()
+        assert mask is not None
+        keep = None
+        if self.token_pruning is not None:
+            keep = self.token_pruning.keep_tokens(samples.tensors, mask)
+        layers = self.transformer.decode_layers(self.input_proj(src), mask, self.query_embed.weight, pos[-1],
+                                                keep=keep)
+        prev_logits, prev_boxes = None, None
+        for num_layers, hs in enumerate(layers, start=1):
+            if self.early_exit is None:
+                continue
+            outputs_class = self.class_embed(hs)
+            outputs_coord = self.bbox_embed(hs).sigmoid()
+            if self.early_exit.converged(num_layers, prev_logits, prev_boxes, outputs_class, outputs_coord):
+                break
+            prev_logits, prev_boxes = outputs_class, outputs_coord
+        layers.close()
+        if self.early_exit is None:
+            outputs_class = self.class_embed(hs)
+            outputs_coord = self.bbox_embed(hs).sigmoid()
+        else:
+            self.early_exit.record(num_layers, self.transformer.decoder.num_layers)
+        return {'pred_logits': outputs_class, 'pred_boxes': outputs_coord}
+
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
         # this is a workaround to make torchscript happy, as torchscript
@@ -307,6 +353,141 @@ class MLP(nn.Module):
         return x
 
 
+class EarlyExit(object):
+    """
+    Convergence test for decoding with fewer decoder layers at inference, see DETR.forward_inference.
+
+    After layer n >= min_layers, decoding stops when, compared to layer n - 1 and over the whole batch:
+        * at least class_agreement of the queries keep their predicted class (no-object included),
+        * no query predicted as an object moved a box coordinate by more than box_delta
+          (normalized [0, 1] coordinates),
+        * every query predicts its class with probability at least min_confidence.
+    exit_counts[n - 1] counts the forwards that stopped after layer n.
+    """
+    def __init__(self, min_layers=2, class_agreement=1.0, box_delta=0.01, min_confidence=0.5):
+        self.min_layers = max(min_layers, 2)
+        self.class_agreement = class_agreement
+        self.box_delta = box_delta
+        self.min_confidence = min_confidence
+        self.exit_counts = []
+
+    def converged(self, num_layers, prev_logits, prev_boxes, logits, boxes):
+        if num_layers < self.min_layers or prev_logits is None:
+            return False
+        probs = logits.float().softmax(-1)
+        scores, labels = probs.max(-1)
+        if scores.min() < self.min_confidence:
+            return False
+        prev_labels = prev_logits.argmax(-1)
+        if (labels == prev_labels).float().mean() < self.class_agreement:
+            return False
+        is_object = labels != logits.shape[-1] - 1
+        if is_object.any():
+            delta = (boxes.float() - prev_boxes.float()).abs().amax(-1)
+            if delta[is_object].max() > self.box_delta:
+                return False
+        return True
+
+    def record(self, num_layers, max_layers):
+        if len(self.exit_counts) < max_layers:
+            self.exit_counts.extend([0] * (max_layers - len(self.exit_counts)))
+        self.exit_counts[num_layers - 1] += 1
+
+    def summary(self):
+        """
+        output: dict with the number of forwards, the mean number of decoder layers run,
+                and the share of forwards that exited after each layer
+        """
+        total = sum(self.exit_counts)
+        if total == 0:
+            return {'forwards': 0}
+        return {'forwards': total,
+                'mean_layers': sum((idx + 1) * count for idx, count in enumerate(self.exit_counts)) / total,
+                'exit_rates': [count / total for count in self.exit_counts]}
+
+
+def enable_early_exit(model, early_exit):
+    """
+    Let a DETR model in eval mode stop decoding early with an EarlyExit policy (None turns it off).
+    Has no effect on traced, scripted or compiled graphs of the model.
+    """
+    if isinstance(model, DETRsegm):
+        model = model.detr
+    model.early_exit = early_exit
+    return model
+
+
+class TokenPruning(object):
+    """
+    Whitespace pruning of the transformer input at inference, see DETR.forward_inference.
+
+    A feature location is blank when the image patch it covers (stride x stride pixels) is uniform:
+    on every channel, max - min of the normalized image stays below blank_range (0.5 is about 0.11 of
+    the intensity range with the ImageNet normalization). Only locations within margin cells
+    of a non-blank one are kept; the others do not enter the encoder and the decoder does not attend to them.
+    tokens and kept_tokens count the unpadded feature locations seen and kept.
+    """
+    def __init__(self, blank_range=0.5, margin=1, stride=32):
+        self.blank_range = blank_range
+        self.margin = margin
+        self.stride = stride
+        self.tokens = 0
+        self.kept_tokens = 0
+
+    def keep_tokens(self, images, mask):
+        """
+        images: normalized image batch [bs, 3, H, W]; mask: feature padding mask [bs, h, w]
+        output: bool tensor [bs, h, w], True on the feature locations to keep
+        """
+        images = images.float()
+        patch_max = F.max_pool2d(images, self.stride, ceil_mode=True)
+        patch_min = -F.max_pool2d(-images, self.stride, ceil_mode=True)
+        content = ((patch_max - patch_min).amax(1, keepdim=True) >= self.blank_range).float()
+        if self.margin > 0:
+            content = F.max_pool2d(content, 2 * self.margin + 1, stride=1, padding=self.margin)
+        if content.shape[-2:] != mask.shape[-2:]:
+            content = F.interpolate(content, size=mask.shape[-2:])
+        keep = content[:, 0].bool() & ~mask
+        # a blank page keeps everything, like select_tokens does
+        keep = torch.where(keep.flatten(1).any(1)[:, None, None], keep, ~mask)
+        self.tokens += int((~mask).sum())
+        self.kept_tokens += int(keep.sum())
+        return keep
+
+    def reset(self):
+        self.tokens = 0
+        self.kept_tokens = 0
+
+    def summary(self):
+        return {'tokens': self.tokens, 'kept_tokens': self.kept_tokens,
+                'kept_rate': self.kept_tokens / self.tokens if self.tokens > 0 else None}
+
+
+def enable_token_pruning(model, token_pruning):
+    """
+    Let a DETR model in eval mode drop blank feature locations with a TokenPruning policy (None turns it off).
+    Has no effect on traced, scripted or compiled graphs of the model.
+    """
+    if isinstance(model, DETRsegm):
+        model = model.detr
+    model.token_pruning = token_pruning
+    return model
+
+
+def optimize_for_inference(model):
+    """
+    Inference-only graph simplifications for a model in eval mode: fold the frozen BatchNorms of the
+    backbone into its convolutions, and for plain DETR (which only reads the last feature map)
+    stop computing the other backbone outputs, their masks and position encodings.
+    """
+    if isinstance(model, DETRsegm):
+        fold_frozen_batchnorm(model.detr.backbone[0].body)
+        return model
+    fold_frozen_batchnorm(model.backbone[0].body)
+    model.backbone[0].keep_last_output()
+    return model
+
+
 def build(args):
     num_classes=args.num_classes
     device = torch.device(args.device)
@@ -15,7 +15,9 @@ class PositionEmbeddingSine(nn.Module):
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
     """
-    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None):
+    __jit_ignored_attributes__ = ['cache']
+
+    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None, cache_size=64):
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperature = temperature
@@ -25,6 +27,9 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # unmasked position encodings by (h, w, device), see forward_unmasked
+        self.cache = {}
+        self.cache_size = cache_size
 
     def forward(self, tensor_list: NestedTensor):
         x = tensor_list.tensors
@@ -33,12 +38,15 @@ class PositionEmbeddingSine(nn.Module):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
+        return self.embed(y_embed, x_embed)
+
+    def embed(self, y_embed, x_embed):
         if self.normalize:
             eps = 1e-6
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x_embed.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
@@ -48,6 +56,24 @@ class PositionEmbeddingSine(nn.Module):
         pos = torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
         return pos
 
+    @torch.jit.unused
+    def forward_unmasked(self, h: int, w: int, device: torch.device):
+        """
+        Position encoding of a h x w feature map without padding (an all-False mask), which only
+        depends on the shape: the cumsums of the mask are replaced by aranges and the result is cached.
+        Returns a [1, 2 * num_pos_feats, h, w] tensor; do not modify it in place.
+        """
+        key = (h, w, device)
+        pos = self.cache.get(key)
+        if pos is None:
+            y_embed = torch.arange(1, h + 1, dtype=torch.float32, device=device)[None, :, None].expand(1, h, w)
+            x_embed = torch.arange(1, w + 1, dtype=torch.float32, device=device)[None, None, :].expand(1, h, w)
+            pos = self.embed(y_embed, x_embed)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = pos
+        return pos
+
 
 class PositionEmbeddingLearned(nn.Module):
     """
@@ -6,6 +6,7 @@ Copy-paste from torch.nn.Transformer with modifications:
     * positional encodings are passed in MHattention
     * extra LN at the end of encoder is removed
     * decoder returns a stack of activations from all decoding layers
+    * attention can run through F.scaled_dot_product_attention (attention="sdpa")
 """
 import copy
 from typing import Optional, List
@@ -20,16 +21,16 @@ class Transformer(nn.Module):
     def __init__(self, d_model=512, nhead=8, num_encoder_layers=6,
                  num_decoder_layers=6, dim_feedforward=2048, dropout=0.1,
                  activation="relu", normalize_before=False,
-                 return_intermediate_dec=False):
+                 return_intermediate_dec=False, attention="multihead"):
         super().__init__()
 
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attention)
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
         self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
 
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attention)
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm,
                                           return_intermediate=return_intermediate_dec)
@@ -58,6 +59,51 @@ class Transformer(nn.Module):
                           pos=pos_embed, query_pos=query_embed)
         return hs.transpose(1, 2), memory.permute(1, 2, 0).view(bs, c, h, w)
 
+    @torch.jit.unused
+    def decode_layers(self, src, mask, query_embed, pos_embed, keep: Optional[Tensor] = None):
+        """
+        Like forward, but yields the normalized output of each decoder layer ([bs, num_queries, d_model],
+        the same as forward's intermediate outputs) as soon as it is computed, so decoding can stop early.
+
+        keep: optional bool tensor [bs, h, w]. Only the feature locations where it is True go through
+              the encoder and are attended to by the decoder, see select_tokens.
+        """
+        bs, c, h, w = src.shape
+        src = src.flatten(2).permute(2, 0, 1)
+        pos_embed = pos_embed.flatten(2).permute(2, 0, 1)
+        query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)
+        mask = mask.flatten(1)
+        if keep is not None:
+            src, pos_embed, mask = select_tokens(src, pos_embed, mask, keep.flatten(1))
+
+        output = torch.zeros_like(query_embed)
+        memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
+        for layer in self.decoder.layers:
+            output = layer(output, memory, memory_key_padding_mask=mask,
+                           pos=pos_embed, query_pos=query_embed)
+            yield self.decoder.norm(output).transpose(0, 1)
+
+
+def select_tokens(src, pos_embed, mask, keep):
+    """
+    Drop tokens from a flattened feature map: src and pos_embed [HW, bs, c], mask and keep [bs, HW].
+    The kept tokens of each image are moved to the front in their original order and the sequence
+    is cut to the largest number kept; the padding mask is rebuilt for the shorter sequence.
+    Images where no unpadded token would be kept keep all of them.
+    Position embeddings travel with their tokens, so attention still sees where each token is.
+    """
+    keep = keep & ~mask
+    keep = torch.where(keep.any(1, keepdim=True), keep, ~mask)
+    num_kept = keep.sum(1)
+    seq_len = int(num_kept.max())
+    # stable sort puts the kept tokens first without reordering them
+    index = torch.sort((~keep).to(torch.uint8), dim=1, stable=True)[1][:, :seq_len]
+    index = index.t().unsqueeze(-1).expand(-1, -1, src.shape[-1])
+    src = src.gather(0, index)
+    pos_embed = pos_embed.gather(0, index)
+    mask = torch.arange(seq_len, device=mask.device)[None, :] >= num_kept[:, None]
+    return src, pos_embed, mask
+
 
 class TransformerEncoder(nn.Module):
 
@@ -127,9 +173,9 @@ class TransformerDecoder(nn.Module):
 class TransformerEncoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention="multihead"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention(attention, d_model, nhead, dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -187,10 +233,10 @@ class TransformerEncoderLayer(nn.Module):
 class TransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attention="multihead"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention(attention, d_model, nhead, dropout)
+        self.multihead_attn = _get_attention(attention, d_model, nhead, dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -269,6 +315,54 @@ class TransformerDecoderLayer(nn.Module):
                                  tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
 
 
+class SDPAttention(nn.MultiheadAttention):
+    """
+    nn.MultiheadAttention computed with F.scaled_dot_product_attention, which never materializes
+    the attention weights. It has the same parameters, so checkpoints load unchanged.
+    Inputs are sequence first [L, N, E]; returns (output, None) in place of (output, weights).
+    """
+
+    def forward(self, query: Tensor, key: Tensor, value: Tensor,
+                key_padding_mask: Optional[Tensor] = None,
+                need_weights: bool = False,
+                attn_mask: Optional[Tensor] = None):
+        tgt_len, bsz, embed_dim = query.shape
+        src_len = key.shape[0]
+        head_dim = embed_dim // self.num_heads
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        # [L, N, E] -> [N, heads, L, head_dim]
+        q = F.linear(query, w_q, b_q).view(tgt_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        k = F.linear(key, w_k, b_k).view(src_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        v = F.linear(value, w_v, b_v).view(src_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+
+        # boolean masks of scaled_dot_product_attention are True where attention is allowed
+        mask: Optional[Tensor] = None
+        if key_padding_mask is not None:
+            mask = ~key_padding_mask.view(bsz, 1, 1, src_len)
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                attn_mask = ~attn_mask
+                mask = attn_mask if mask is None else mask & attn_mask
+            elif mask is not None:
+                mask = attn_mask.masked_fill(~mask, float("-inf"))
+            else:
+                mask = attn_mask
+
+        dropout_p = self.dropout if self.training else 0.0
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+        output = output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(output), None
+
+
+def _get_attention(attention, d_model, nhead, dropout):
+    if attention == "multihead":
+        return nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+    if attention == "sdpa":
+        return SDPAttention(d_model, nhead, dropout=dropout)
+    raise ValueError(f"attention should be multihead/sdpa, not {attention}.")
+
+
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
@@ -283,6 +377,7 @@ def build_transformer(args):
         num_decoder_layers=args.dec_layers,
         normalize_before=args.pre_norm,
         return_intermediate_dec=True,
+        attention=getattr(args, 'attention', 'multihead'),
     )
 
 
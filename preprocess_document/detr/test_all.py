@@ -6,7 +6,9 @@ import torch
 
 from models.matcher import HungarianMatcher
 from models.position_encoding import PositionEmbeddingSine, PositionEmbeddingLearned
-from models.backbone import Backbone, Joiner, BackboneBase
+from models.backbone import Backbone, Joiner, BackboneBase, FrozenBatchNorm2d, fold_frozen_batchnorm
+from models.transformer import Transformer
+from models.detr import DETR, EarlyExit, TokenPruning, enable_early_exit, enable_token_pruning
 from util import box_ops
 from util.misc import nested_tensor_from_tensor_list
 from hubconf import detr_resnet50, detr_resnet50_panoptic
@@ -66,6 +68,102 @@ class Tester(unittest.TestCase):
         backbone = Backbone('resnet50', True, False, False)
         torch.jit.script(backbone)  # noqa
 
+    def test_fold_frozen_batchnorm(self):
+        backbone = Backbone('resnet18', False, True, False).eval()
+        for module in backbone.modules():
+            if isinstance(module, FrozenBatchNorm2d):
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.5, 0.5)
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 1.5)
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])
+        with torch.no_grad():
+            out = backbone(x)
+            fold_frozen_batchnorm(backbone.body)
+            backbone.keep_last_output()
+            out_folded = backbone(x)
+        self.assertFalse(any(isinstance(module, FrozenBatchNorm2d) for module in backbone.modules()))
+        self.assertEqual(len(out_folded), 1)
+        self.assertLess((out["3"].tensors - out_folded["0"].tensors).abs().max(), 1e-4)
+
+    def test_position_encoding_cache(self):
+        position_embedding = PositionEmbeddingSine(64, normalize=True)
+        joiner = Joiner(Backbone('resnet18', False, False, False), position_embedding).eval()
+        for x in (nested_tensor_from_tensor_list([torch.rand(3, 200, 250), torch.rand(3, 200, 250)]),
+                  nested_tensor_from_tensor_list([torch.rand(3, 200, 200), torch.rand(3, 200, 250)])):
+            with torch.no_grad():
+                out, pos = joiner(x)
+            self.assertTrue(torch.equal(pos[-1], position_embedding(out[-1])))
+        # only the unpadded batch is cached
+        self.assertEqual(len(position_embedding.cache), 1)
+
+    def test_sdpa_attention(self):
+        transformer = Transformer(d_model=64, nhead=4, num_encoder_layers=2, num_decoder_layers=2,
+                                  normalize_before=True, return_intermediate_dec=True).eval()
+        transformer_sdpa = Transformer(d_model=64, nhead=4, num_encoder_layers=2, num_decoder_layers=2,
+                                       normalize_before=True, return_intermediate_dec=True, attention="sdpa").eval()
+        transformer_sdpa.load_state_dict(transformer.state_dict())
+        src, pos, query_embed = torch.rand(2, 64, 10, 12), torch.rand(2, 64, 10, 12), torch.rand(20, 64)
+        mask = torch.zeros(2, 10, 12, dtype=torch.bool)
+        mask[1, 7:] = True
+        with torch.no_grad():
+            hs, memory = transformer(src, mask, query_embed, pos)
+            hs_sdpa, memory_sdpa = transformer_sdpa(src, mask, query_embed, pos)
+            hs_script = torch.jit.script(transformer_sdpa)(src, mask, query_embed, pos)[0]
+        self.assertTrue(torch.allclose(hs, hs_sdpa, atol=1e-5))
+        self.assertTrue(torch.allclose(memory, memory_sdpa, atol=1e-5))
+        self.assertTrue(torch.allclose(hs_sdpa, hs_script, atol=1e-6))
+
+    def test_early_exit(self):
+        backbone = Joiner(Backbone('resnet18', False, False, False), PositionEmbeddingSine(32, normalize=True))
+        backbone.num_channels = 512
+        transformer = Transformer(d_model=64, nhead=4, num_encoder_layers=2, num_decoder_layers=4,
+                                  normalize_before=True, return_intermediate_dec=True)
+        model = DETR(backbone, transformer, num_classes=5, num_queries=20).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 200, 250), torch.rand(3, 180, 250)])
+        with torch.no_grad():
+            out = model(x)
+            # thresholds that are never met run every layer
+            never = EarlyExit(box_delta=-1)
+            enable_early_exit(model, never)
+            self.assertTrue(torch.equal(model(x)['pred_boxes'], out['pred_boxes']))
+            self.assertEqual(never.exit_counts, [0, 0, 0, 1])
+            # thresholds that are always met stop after min_layers, with that layer's predictions
+            always = EarlyExit(min_layers=3, class_agreement=0, box_delta=float('inf'), min_confidence=0)
+            enable_early_exit(model, always)
+            out_early = model(x)
+            enable_early_exit(model, None)
+            model.aux_loss = True
+            aux_outputs = model(x)['aux_outputs']
+        self.assertTrue(torch.allclose(out_early['pred_logits'], aux_outputs[2]['pred_logits'], atol=1e-6))
+        self.assertEqual(always.exit_counts, [0, 0, 1, 0])
+        self.assertEqual(always.summary()['mean_layers'], 3)
+
+    def test_token_pruning(self):
+        backbone = Joiner(Backbone('resnet18', False, False, False), PositionEmbeddingSine(32, normalize=True))
+        backbone.num_channels = 512
+        transformer = Transformer(d_model=64, nhead=4, num_encoder_layers=2, num_decoder_layers=2,
+                                  normalize_before=True, return_intermediate_dec=True)
+        model = DETR(backbone, transformer, num_classes=5, num_queries=20).eval()
+        # blank pages with content in the top left 64x64 pixels
+        images = [torch.zeros(3, 256, 320), torch.zeros(3, 224, 320)]
+        for image in images:
+            image[:, :64, :64] = torch.rand(3, 64, 64)
+        x = nested_tensor_from_tensor_list(images)
+        with torch.no_grad():
+            out = model(x)
+            keep_all = TokenPruning(blank_range=-1)
+            enable_token_pruning(model, keep_all)
+            self.assertTrue(torch.allclose(model(x)['pred_boxes'], out['pred_boxes'], atol=1e-6))
+            pruning = TokenPruning(margin=1)
+            enable_token_pruning(model, pruning)
+            model(x)
+        self.assertEqual(keep_all.kept_tokens, 8 * 10 + 7 * 10)
+        # 2x2 content cells and a margin of one cell around them, per page
+        self.assertEqual(pruning.kept_tokens, 2 * 3 * 3)
+        pruning.reset()
+        self.assertEqual(pruning.summary()['kept_rate'], None)
+
     def test_model_script_detection(self):
         model = detr_resnet50(pretrained=False).eval()
         scripted_model = torch.jit.script(model)
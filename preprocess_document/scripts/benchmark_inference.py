@@ -0,0 +1,129 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+from PIL import Image
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.append(src_dir)
+sys.path.append(os.path.join(src_dir, '..', 'detr'))
+from inference import TableExtractionPipeline
+from models.detr import TokenPruning
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', help='directory of page images')
+    parser.add_argument('--detection_config_path', default=os.path.join(src_dir, 'detection_config.json'))
+    parser.add_argument('--detection_model_path')
+    parser.add_argument('--max_images', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='intra-op threads for every configuration. Default: torch\'s own choice.')
+    parser.add_argument('--configs', nargs='+', default=['channels_last', 'bf16', 'channels_last+bf16'],
+                        help='configurations compared against the fp32 eager baseline, '
+                             'combinations of channels_last, bf16, prune (whitespace token pruning) '
+                             'and crop (page margins cropped before detection) joined by +')
+    parser.add_argument('--pruning_blank_range', type=float, default=0.5,
+                        help='blank_range of models.detr.TokenPruning for the prune configurations')
+    parser.add_argument('--pruning_margin', type=int, default=1,
+                        help='margin of models.detr.TokenPruning for the prune configurations')
+    parser.add_argument('--iou_threshold', type=float, default=0.5,
+                        help='min IoU for a table to count as detected by both the baseline and a configuration')
+    args = parser.parse_args()
+    return args
+
+def get_tables(objects, class_thresholds):
+    return [obj for obj in objects if obj['score'] >= class_thresholds[obj['label']]]
+
+def iou(bbox1, bbox2):
+    intersection = max(0, min(bbox1[2], bbox2[2]) - max(bbox1[0], bbox2[0])) \
+        * max(0, min(bbox1[3], bbox2[3]) - max(bbox1[1], bbox2[1]))
+    area1 = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1])
+    area2 = (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1])
+    union = area1 + area2 - intersection
+    return intersection / union if union > 0 else 0
+
+def detection_agreement(baseline_pages, pages, iou_threshold=0.5):
+    """
+    Greedily match the tables of each page to the baseline tables of the same label.
+
+    output: (number of matched tables, baseline tables, compared tables, mean IoU of matched tables)
+    """
+    matched, baseline_count, count, ious = 0, 0, 0, []
+    for baseline_tables, tables in zip(baseline_pages, pages):
+        baseline_count += len(baseline_tables)
+        count += len(tables)
+        unmatched = list(baseline_tables)
+        for table in sorted(tables, key=lambda obj: obj['score'], reverse=True):
+            candidates = [(iou(table['bbox'], other['bbox']), idx) for idx, other in enumerate(unmatched)
+                          if other['label'] == table['label']]
+            if len(candidates) == 0:
+                continue
+            best_iou, best_idx = max(candidates)
+            if best_iou >= iou_threshold:
+                matched += 1
+                ious.append(best_iou)
+                unmatched.pop(best_idx)
+    return matched, baseline_count, count, float(np.mean(ious)) if ious else None
+
+def benchmark_config(pipe, imgs, batch_size=1):
+    """
+    output: (per-batch latencies divided by batch size in seconds, per-page detected tables)
+    """
+    # warm up allocator and oneDNN primitive caches
+    pipe.detect_batch(imgs[:batch_size], batch_size=batch_size)
+    # the kept-token rate covers the timed pages only
+    if not pipe.det_token_pruning is None:
+        pipe.det_token_pruning.reset()
+
+    latencies, pages = [], []
+    for start in range(0, len(imgs), batch_size):
+        batch = imgs[start:start + batch_size]
+        tic = time.perf_counter()
+        outputs = pipe.detect_batch(batch, batch_size=batch_size)
+        latencies.extend([(time.perf_counter() - tic) / len(batch)] * len(batch))
+        pages.extend(get_tables(output['objects'], pipe.det_class_thresholds) for output in outputs)
+    return latencies, pages
+
+if __name__ == "__main__":
+    warnings.filterwarnings('ignore')
+    args = get_args()
+    img_files = sorted(os.listdir(args.image_dir))[:args.max_images]
+    imgs = [Image.open(os.path.join(args.image_dir, img_file)).convert('RGB') for img_file in img_files]
+
+    print(f'Benchmarking table detection on {len(imgs)} images, batch size {args.batch_size}, '
+          f'{args.num_threads or torch.get_num_threads()} threads.')
+    results = {}
+    for config in ['fp32'] + args.configs:
+        options = config.split('+')
+        token_pruning = None
+        if 'prune' in options:
+            token_pruning = TokenPruning(blank_range=args.pruning_blank_range, margin=args.pruning_margin)
+        pipe = TableExtractionPipeline(det_device='cpu', det_config_path=args.detection_config_path,
+                                       det_model_path=args.detection_model_path,
+                                       channels_last='channels_last' in options,
+                                       autocast_dtype=torch.bfloat16 if 'bf16' in options else None,
+                                       num_threads=args.num_threads,
+                                       det_token_pruning=token_pruning,
+                                       crop_margins='crop' in options)
+        latencies, pages = benchmark_config(pipe, imgs, batch_size=args.batch_size)
+        kept_rate = token_pruning.summary()['kept_rate'] if not token_pruning is None else 1.0
+        results[config] = (latencies, pages, kept_rate)
+
+    baseline_latency = np.mean(results['fp32'][0])
+    print(f'{"config":>20} {"tokens":>7} {"mean":>8} {"p50":>8} {"p90":>8} {"speedup":>8} {"agreement":>10} '
+          f'{"mean IoU":>9}')
+    for config, (latencies, pages, kept_rate) in results.items():
+        matched, baseline_count, count, mean_iou = detection_agreement(results['fp32'][1], pages,
+                                                                       iou_threshold=args.iou_threshold)
+        # tables found by both / tables found by either
+        union = baseline_count + count - matched
+        agreement = matched / union if union > 0 else 1.0
+        p50, p90 = np.percentile(latencies, [50, 90])
+        mean_iou = f'{mean_iou:.3f}' if mean_iou is not None else '-'
+        print(f'{config:>20} {kept_rate:7.1%} {np.mean(latencies):7.3f}s {p50:7.3f}s {p90:7.3f}s '
+              f'{baseline_latency / np.mean(latencies):7.2f}x {agreement:10.3f} {mean_iou:>9}')
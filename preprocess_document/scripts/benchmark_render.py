@@ -0,0 +1,54 @@
+import argparse
+import platform
+import time
+from pathlib import Path
+
+import fitz
+
+from convert_pdf_to_image import get_words_from_pdf, iter_rendered_pages
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', help='input PDF data directory')
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--max_pages', type=int, default=None,
+                        help='stop each backend after this many pages in total')
+    parser.add_argument('--backends', nargs='+', choices=('pymupdf', 'pdf2image'),
+                        default=['pdf2image', 'pymupdf'])
+    args = parser.parse_args()
+    return args
+
+def benchmark_backend(pdf_files, backend, dpi=300, max_pages=None):
+    """
+    Render every page and extract its words in memory (nothing is written to disk).
+
+    output: (number of rendered pages, elapsed seconds)
+    """
+    page_count = 0
+    start = time.perf_counter()
+    for fname in pdf_files:
+        with fitz.open(fname) as doc:
+            last_page = doc.page_count
+            if max_pages is not None:
+                last_page = min(last_page, max_pages - page_count)
+            if last_page < 1:
+                break
+            page_nums = range(1, last_page + 1)
+            for page_num, page in iter_rendered_pages(fname, page_nums, dpi=dpi, backend=backend, doc=doc):
+                get_words_from_pdf(doc[page_num - 1], page.size)
+                page_count += 1
+    return page_count, time.perf_counter() - start
+
+if __name__ == "__main__":
+    args = get_args()
+    root = Path(args.input_dir)
+
+    os_type = platform.system()
+    separator = '/' if os_type == 'Linux' else '\\' # windows
+    pdf_files = sorted(list(root.glob(f'**{separator}*.[pP][dD][fF]')))
+
+    print(f'Benchmarking {len(pdf_files)} pdf files at {args.dpi} dpi.')
+    for backend in args.backends:
+        page_count, elapsed = benchmark_backend(pdf_files, backend, dpi=args.dpi, max_pages=args.max_pages)
+        pages_per_sec = page_count / elapsed if elapsed > 0 else 0
+        print(f'{backend:>10}: {page_count} pages in {elapsed:.2f}s, {pages_per_sec:.2f} pages/sec')
@@ -3,16 +3,58 @@ import fitz
 from pathlib import Path
 import argparse
 import platform
-from PIL import ImageDraw
+from PIL import Image, ImageDraw
 import json
 import os
+import hashlib
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+from words_format import write_words
+from prescreen import table_likelihood
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', help='input PDF data directory')
     parser.add_argument('--output_dir', help='output image directory')
     parser.add_argument('--postfix', choices=('.jpg', '.png'))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes. 1 converts in the current process.')
+    parser.add_argument('--pages_per_task', type=int, default=16,
+                        help='max pages per worker task, so large PDFs are split across workers.')
+    parser.add_argument('--max_pages_in_flight', type=int, default=4,
+                        help='max rendered pages held in memory at once per worker.')
+    parser.add_argument('--backend', choices=('pymupdf', 'pdf2image'), default='pdf2image',
+                        help='renderer. pymupdf renders from the already opened fitz document, '
+                             'pdf2image runs a poppler subprocess.')
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--max_size', type=int, default=None,
+                        help='render each page so its longest side is max_size pixels, ignoring --dpi. '
+                             'Use 800 to render pages directly at detection model resolution.')
+    parser.add_argument('--words_format', choices=('json', 'bin'), default='json',
+                        help='json writes indented word dicts, bin writes the columnar binary words format '
+                             '(see src/words_format.py).')
+    parser.add_argument('--prescreen_threshold', type=float, default=None,
+                        help='skip rendering pages whose table likelihood from vector graphics and text layout '
+                             'is below this threshold (0-1). Skipped pages are listed in skipped_pages.json.')
+    parser.add_argument('--force', action='store_true',
+                        help='re-render every PDF, ignoring the manifest of already converted PDFs.')
+    parser.add_argument('--metrics_file', default=None,
+                        help='JSON lines file the per-page and per-document metrics are appended to. '
+                             'Default: {output_dir}/metrics.jsonl')
+    parser.add_argument('--summary', action='store_true',
+                        help='print throughput percentiles and the slowest documents from the metrics file '
+                             'instead of converting.')
     args = parser.parse_args()
     return args
 
@@ -38,10 +80,345 @@ def get_words_from_pdf(page, image_size):
                    'block_num': x[5]} for i, x in enumerate(page_words)]
     return page_words
 
+def split_page_ranges(page_count, pages_per_task):
+    """
+    Split [1, page_count] into (first_page, last_page) ranges of at most pages_per_task pages.
+    """
+    pages_per_task = max(1, pages_per_task)
+    return [(first, min(first + pages_per_task - 1, page_count))
+            for first in range(1, page_count + 1, pages_per_task)]
+
+def split_consecutive_runs(page_nums, max_length):
+    """
+    Split ascending page numbers into (first_page, last_page) runs of consecutive pages,
+    each at most max_length pages long.
+    """
+    runs = []
+    for page_num in page_nums:
+        if runs and runs[-1][1] == page_num - 1 and page_num - runs[-1][0] < max_length:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
+    return [tuple(run) for run in runs]
+
+def render_page_pymupdf(page, dpi=300, max_size=None):
+    """
+    page: fitz.Page
+    output: PIL.Image rendered at the given dpi, or with its longest side at max_size pixels
+    """
+    if max_size is None:
+        zoom = dpi / 72
+    else:
+        zoom = max_size / max(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+def iter_rendered_pages(fname, page_nums, dpi=300, max_pages_in_flight=4,
+                        backend='pdf2image', doc=None, max_size=None):
+    """
+    Yield (page_num, PIL.Image) for the given ascending 1-based page numbers one at a time.
+    At most max_pages_in_flight pages are decoded at once, so peak memory does not grow with document length.
+    Each image is closed once the caller moves on to the next page.
+
+    backend 'pymupdf' renders from doc (an open fitz.Document) one page at a time.
+    backend 'pdf2image' renders runs of up to max_pages_in_flight consecutive pages with poppler.
+    If max_size is given, pages are fitted to a max_size x max_size box instead of rendered at dpi.
+    """
+    if backend == 'pymupdf':
+        for page_num in page_nums:
+            page = render_page_pymupdf(doc[page_num - 1], dpi=dpi, max_size=max_size)
+            yield page_num, page
+            page.close()
+            del page
+        return
+
+    max_pages_in_flight = max(1, max_pages_in_flight)
+    for chunk_first, chunk_last in split_consecutive_runs(page_nums, max_pages_in_flight):
+        pages = convert_from_path(fname, dpi=dpi, first_page=chunk_first, last_page=chunk_last, size=max_size)
+        page_num = chunk_first
+        while pages:
+            page = pages.pop(0)
+            yield page_num, page
+            page.close()
+            del page
+            page_num += 1
+
+def convert_pages(fname, first_page, last_page, res_image, res_word, postfix, dpi=300, max_pages_in_flight=4,
+                  backend='pdf2image', max_size=None, words_format='json', prescreen_threshold=None):
+    """
+    Render pages [first_page, last_page] (1-based, inclusive) of one PDF and save images and words.
+    Runs in a worker process, so every argument must be picklable.
+    If prescreen_threshold is given, pages whose table likelihood is below it are not rendered.
+
+    output: (number of saved pages, list of page numbers skipped by the prescreen, list of per-page metrics)
+    """
+    pdf_filename = Path(fname).stem
+    pages_fitz = fitz.open(fname)
+
+    page_nums = list(range(first_page, last_page + 1))
+    skipped_pages = []
+    if prescreen_threshold is not None:
+        skipped_pages = [page_num for page_num in page_nums
+                         if table_likelihood(pages_fitz[page_num - 1]) < prescreen_threshold]
+        page_nums = [page_num for page_num in page_nums if page_num not in skipped_pages]
+
+    saved_count = 0
+    page_metrics = []
+    # pdf2image renders pages in chunks, so the first page of a chunk carries the render time of the whole chunk
+    tic = time.perf_counter()
+    for page_num, page in iter_rendered_pages(fname, page_nums, dpi=dpi,
+                                              max_pages_in_flight=max_pages_in_flight,
+                                              backend=backend, doc=pages_fitz, max_size=max_size):
+        render_time = time.perf_counter() - tic
+        print(f'{pdf_filename}_page{page_num}{postfix}')
+        tic = time.perf_counter()
+        page_words = get_words_from_pdf(pages_fitz[page_num - 1], page.size)
+        words_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        image_path = Path(res_image) / f'{pdf_filename}_page{page_num}{postfix}'
+        page.save(image_path)
+        if words_format == 'bin':
+            words_path = Path(res_word) / f'{pdf_filename}_page{page_num}_words.bin'
+            write_words(words_path, page_words)
+        else:
+            words_path = Path(res_word) / f'{pdf_filename}_page{page_num}_words.json'
+            with open(words_path, 'w', encoding='utf-8') as f:
+                json.dump(page_words, f, indent=2, ensure_ascii=False)
+        write_time = time.perf_counter() - tic
+
+        page_metrics.append({'type': 'page',
+                             'pdf': str(fname),
+                             'page': page_num,
+                             'width': page.size[0],
+                             'height': page.size[1],
+                             # image pixels per PDF point; not dpi / 72 when rendered with max_size
+                             'scale': [page.size[0] / pages_fitz[page_num - 1].rect.width,
+                                       page.size[1] / pages_fitz[page_num - 1].rect.height],
+                             'words': len(page_words),
+                             'render_time': render_time,
+                             'words_time': words_time,
+                             'write_time': write_time,
+                             'image_bytes': os.path.getsize(image_path),
+                             'words_bytes': os.path.getsize(words_path),
+                             'peak_rss_mb': get_peak_rss_mb(),
+                             'pid': os.getpid()})
+        saved_count += 1
+        tic = time.perf_counter()
+    pages_fitz.close()
+
+    return saved_count, skipped_pages, page_metrics
+
+def get_peak_rss_mb():
+    """
+    output: peak resident set size of the current process in MB, or None where the resource module is missing
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+def get_document_metrics(fname, page_metrics, page_count, skipped_pages, error=None):
+    """
+    Aggregate the per-page metrics of one PDF into a per-document record.
+    """
+    render_time = sum(metrics['render_time'] for metrics in page_metrics)
+    words_time = sum(metrics['words_time'] for metrics in page_metrics)
+    write_time = sum(metrics['write_time'] for metrics in page_metrics)
+    total_time = render_time + words_time + write_time
+    peak_rss = [metrics['peak_rss_mb'] for metrics in page_metrics if metrics['peak_rss_mb'] is not None]
+    return {'type': 'document',
+            'pdf': str(fname),
+            'status': 'failed' if error is not None else 'success',
+            'error': str(error) if error is not None else None,
+            'page_count': page_count,
+            'pages': len(page_metrics),
+            'prescreen_skipped': len(skipped_pages),
+            'render_time': render_time,
+            'words_time': words_time,
+            'write_time': write_time,
+            'total_time': total_time,
+            'max_page_time': max((metrics['render_time'] + metrics['words_time'] + metrics['write_time']
+                                  for metrics in page_metrics), default=0),
+            'pages_per_sec': len(page_metrics) / total_time if total_time > 0 else None,
+            'bytes_written': sum(metrics['image_bytes'] + metrics['words_bytes'] for metrics in page_metrics),
+            'peak_rss_mb': max(peak_rss) if peak_rss else None}
+
+def write_metrics(records, metrics_path, run_info):
+    """
+    Append metric records to a JSON lines file, one record per line.
+    run_info (run time and conversion settings) is added to every record.
+    """
+    with open(metrics_path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps({**run_info, **record}, ensure_ascii=False) + '\n')
+
+def summarize_metrics(metrics_path, top_k=10):
+    """
+    Print throughput percentiles and the slowest documents/pages of a metrics file.
+    """
+    pages = []
+    documents = []
+    with open(metrics_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['type'] == 'page':
+                pages.append(record)
+            elif record['type'] == 'document':
+                documents.append(record)
+
+    percentiles = (50, 90, 99)
+    def print_percentiles(name, values, unit):
+        if len(values) == 0:
+            return
+        values = np.percentile(values, percentiles)
+        text = ', '.join(f'p{p} {value:.3f}{unit}' for p, value in zip(percentiles, values))
+        print(f'{name:>22}: {text}')
+
+    print('======== Metrics summary ========')
+    print(f'{len(documents)} documents, {len(pages)} pages '
+          f'({sum(1 for doc in documents if doc["status"] == "failed")} failed documents)')
+    print('Per page')
+    for key in ('render_time', 'words_time', 'write_time'):
+        print_percentiles(key, [page[key] for page in pages], 's')
+    print_percentiles('bytes_written', [(page['image_bytes'] + page['words_bytes']) / 1024 for page in pages], 'KB')
+    print_percentiles('pixels', [page['width'] * page['height'] / 1e6 for page in pages], 'MP')
+    print('Per document')
+    print_percentiles('pages_per_sec', [doc['pages_per_sec'] for doc in documents
+                                        if doc['pages_per_sec'] is not None], '')
+    print_percentiles('total_time', [doc['total_time'] for doc in documents], 's')
+    print_percentiles('peak_rss_mb', [doc['peak_rss_mb'] for doc in documents
+                                      if doc['peak_rss_mb'] is not None], 'MB')
+
+    print(f'Slowest {top_k} documents')
+    for doc in sorted(documents, key=lambda doc: doc['total_time'], reverse=True)[:top_k]:
+        print(f'{doc["total_time"]:10.2f}s {doc["pages"]:5d} pages  {doc["pdf"]}')
+    print(f'Slowest {top_k} pages')
+    for page in sorted(pages, key=lambda page: page['render_time'] + page['words_time'] + page['write_time'],
+                       reverse=True)[:top_k]:
+        page_time = page['render_time'] + page['words_time'] + page['write_time']
+        print(f'{page_time:10.2f}s {page["width"]}x{page["height"]}  {page["pdf"]} page {page["page"]}')
+
+def get_tasks(pdf_files, pages_per_task):
+    """
+    Build (fname, first_page, last_page) tasks for every PDF.
+    PDFs which cannot be opened are returned separately with their error.
+
+    output: (tasks, {fname: page count}, {fname: exception})
+    """
+    tasks = []
+    page_counts = {}
+    open_errors = {}
+    for fname in pdf_files:
+        try:
+            with fitz.open(fname) as doc:
+                page_count = doc.page_count
+        except Exception as e:
+            open_errors[fname] = e
+            continue
+        page_counts[fname] = page_count
+        for first_page, last_page in split_page_ranges(page_count, pages_per_task):
+            tasks.append((fname, first_page, last_page))
+    return tasks, page_counts, open_errors
+
+def get_file_hash(fname, chunk_size=1 << 20):
+    """
+    output: sha256 hex digest of the file content
+    """
+    file_hash = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def load_manifest(manifest_path):
+    """
+    The manifest maps each PDF (path relative to input_dir) to
+    {"hash": sha256, "page_count": int, "dpi": int, "max_size": int or null, "postfix": str, "words_format": str,
+     "prescreen_threshold": float or null, "skipped_pages": [...], "images": [...], "words": [...]}
+    """
+    if not Path(manifest_path).exists():
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    # 중간에 중단되어도 manifest가 깨지지 않도록 임시 파일에 쓴 뒤 교체
+    tmp_path = Path(str(manifest_path) + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def get_output_paths(fname, page_count, res_image, res_word, postfix, words_format='json', skipped_pages=()):
+    pdf_filename = Path(fname).stem
+    page_nums = [page_num for page_num in range(1, page_count + 1) if page_num not in skipped_pages]
+    images = [str(Path(res_image) / f'{pdf_filename}_page{page_num}{postfix}') for page_num in page_nums]
+    words = [str(Path(res_word) / f'{pdf_filename}_page{page_num}_words.{words_format}') for page_num in page_nums]
+    return images, words
+
+def is_up_to_date(entry, file_hash, dpi, postfix, max_size=None, words_format='json', prescreen_threshold=None):
+    """
+    A PDF is skipped when its content and conversion settings match the manifest entry
+    and every output file recorded for it still exists.
+    """
+    if entry is None:
+        return False
+    if entry['hash'] != file_hash or entry['dpi'] != dpi or entry['postfix'] != postfix:
+        return False
+    if entry.get('max_size') != max_size or entry.get('words_format', 'json') != words_format:
+        return False
+    if entry.get('prescreen_threshold') != prescreen_threshold:
+        return False
+    # max_size renders of older runs did not record their render scales
+    if max_size is not None and 'render_scales' not in entry:
+        return False
+    return all(Path(path).exists() for path in entry['images'] + entry['words'])
+
+def run_tasks(tasks, res_image, res_word, postfix, workers=1, **convert_kwargs):
+    """
+    Run conversion tasks serially or on a process pool.
+    convert_kwargs are passed on to convert_pages.
+
+    output: list of (fname, saved page count, prescreen skipped pages, page metrics, exception or None), one per task
+    """
+    results = []
+    if workers <= 1:
+        for fname, first_page, last_page in tasks:
+            try:
+                saved_count, skipped_pages, page_metrics = convert_pages(fname, first_page, last_page, res_image,
+                                                                         res_word, postfix, **convert_kwargs)
+                results.append((fname, saved_count, skipped_pages, page_metrics, None))
+            except Exception as e:
+                results.append((fname, 0, [], [], e))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_pages, fname, first_page, last_page, res_image, res_word, postfix,
+                                   **convert_kwargs): fname
+                   for fname, first_page, last_page in tasks}
+        for future in as_completed(futures):
+            fname = futures[future]
+            try:
+                saved_count, skipped_pages, page_metrics = future.result()
+                results.append((fname, saved_count, skipped_pages, page_metrics, None))
+            except Exception as e:
+                results.append((fname, 0, [], [], e))
+    return results
+
 if __name__ == "__main__":
     args = get_args()
-    root = Path(args.input_dir)
     res = Path(args.output_dir)
+    metrics_path = Path(args.metrics_file) if args.metrics_file is not None else res / 'metrics.jsonl'
+    if args.summary:
+        summarize_metrics(metrics_path)
+        sys.exit(0)
+
+    root = Path(args.input_dir)
     res_image = res / 'images'
     res_image.mkdir(exist_ok=True, parents=True)
     res_word = res / 'words'
@@ -51,55 +428,129 @@ if __name__ == "__main__":
     os_type = platform.system()
     separator = '/' if os_type == 'Linux' else '\\' # windows
 
-    error_files = []
-    success_files = []
     pdf_files = sorted(list(root.glob(f'**{separator}*.[pP][dD][fF]')))
-    success_imgs_count = 0
 
+    # 이미 변환된 PDF 중 내용/설정이 바뀌지 않은 것은 건너뜀
+    manifest_path = res / 'manifest.json'
+    manifest = load_manifest(manifest_path)
+    file_hashes = {}
+    hash_errors = {}
+    skipped_files = []
+    todo_files = []
     for fname in pdf_files:
-        pdf_basename = fname.stem
-        # 폴더명을 제외한 파일 이름 생성
-        pdf_filename = fname.stem
-
         try:
-            pages = convert_from_path(fname, dpi=300)
-            pages_fitz = fitz.open(fname)
-            print('successful PDF reading')
+            file_hashes[fname] = get_file_hash(fname)
+        except Exception as e:
+            hash_errors[fname] = e
+            continue
+        entry = manifest.get(fname.relative_to(root).as_posix())
+        if not args.force and is_up_to_date(entry, file_hashes[fname], args.dpi, postfix, max_size=args.max_size,
+                                            words_format=args.words_format,
+                                            prescreen_threshold=args.prescreen_threshold):
+            skipped_files.append(fname.stem)
+        else:
+            todo_files.append(fname)
 
-            for page_num, (page, page_fitz) in enumerate(zip(pages, pages_fitz), start=1):
-                print(f'{pdf_filename}_page{page_num}{postfix}')                
-                page_words = get_words_from_pdf(page_fitz, page.size)
+    tasks, page_counts, open_errors = get_tasks(todo_files, args.pages_per_task)
+    results = run_tasks(tasks, res_image, res_word, postfix, workers=args.workers,
+                        max_pages_in_flight=args.max_pages_in_flight, backend=args.backend, dpi=args.dpi,
+                        max_size=args.max_size, words_format=args.words_format,
+                        prescreen_threshold=args.prescreen_threshold)
 
-                page.save(res_image / f'{pdf_filename}_page{page_num}{postfix}')
-                with open(res_word / f'{pdf_filename}_page{page_num}_words.json', 'w', encoding='utf-8') as f:
-                    json.dump(page_words, f, indent=2, ensure_ascii=False)
-                success_imgs_count += 1
+    # 문서 단위로 결과 병합: 한 페이지 구간이라도 실패하면 해당 PDF는 실패로 처리
+    failed = {**hash_errors, **open_errors}
+    success_imgs_count = 0
+    prescreen_skipped = {}
+    page_metrics_by_pdf = {}
+    for fname, saved_count, skipped_pages, page_metrics, error in results:
+        success_imgs_count += saved_count
+        prescreen_skipped.setdefault(fname, []).extend(skipped_pages)
+        page_metrics_by_pdf.setdefault(fname, []).extend(page_metrics)
+        if error is not None and fname not in failed:
+            failed[fname] = error
 
-            success_files.append(pdf_filename)
-            print(f'convert pdf from {fname} to {pdf_filename}_page#{postfix}')
-        except Exception as e:
+    error_files = []
+    success_files = []
+    for fname in pdf_files:
+        pdf_filename = fname.stem
+        manifest_key = fname.relative_to(root).as_posix()
+        if fname in failed:
             print(f'error occured while converting pdf from {fname} to {pdf_filename}_page#{postfix}')
-            print(e)
+            print(failed[fname])
             error_files.append(pdf_filename)
-            continue
+            manifest.pop(manifest_key, None)
+        elif fname in page_counts:
+            print(f'convert pdf from {fname} to {pdf_filename}_page#{postfix}')
+            success_files.append(pdf_filename)
+            skipped_pages = sorted(prescreen_skipped.get(fname, []))
+            images, words = get_output_paths(fname, page_counts[fname], res_image, res_word, postfix,
+                                             words_format=args.words_format, skipped_pages=skipped_pages)
+            manifest[manifest_key] = {'hash': file_hashes[fname],
+                                      'page_count': page_counts[fname],
+                                      'dpi': args.dpi,
+                                      'max_size': args.max_size,
+                                      'postfix': postfix,
+                                      'words_format': args.words_format,
+                                      'prescreen_threshold': args.prescreen_threshold,
+                                      'skipped_pages': skipped_pages,
+                                      'images': images,
+                                      'words': words,
+                                      'render_scales': {str(metrics['page']): metrics['scale']
+                                                        for metrics in page_metrics_by_pdf.get(fname, [])}}
+    save_manifest(manifest, manifest_path)
+
+    # prescreen에서 건너뛴 페이지 목록: document_preprocess에서 텍스트를 그대로 추출하는 데 사용
+    skipped_pages_by_pdf = {Path(key).stem: entry['skipped_pages']
+                            for key, entry in manifest.items() if entry.get('skipped_pages')}
+    with open(res / 'skipped_pages.json', 'w', encoding='utf-8') as f:
+        json.dump(skipped_pages_by_pdf, f, indent=2, ensure_ascii=False)
+    # 페이지별 렌더링 배율(PDF point당 픽셀): document_preprocess에서 좌표를 PDF 좌표로 되돌리는 데 사용
+    render_scales_by_pdf = {Path(key).stem: entry['render_scales']
+                            for key, entry in manifest.items() if entry.get('render_scales')}
+    with open(res / 'render_scales.json', 'w', encoding='utf-8') as f:
+        json.dump(render_scales_by_pdf, f, indent=2, ensure_ascii=False)
+    prescreen_skipped_count = sum(len(pages) for fname, pages in prescreen_skipped.items() if fname not in failed)
 
     # 현재 시간 추가
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+    # 페이지/문서 단위 metric을 JSON lines로 기록
+    metric_records = []
+    for fname in pdf_files:
+        if fname not in page_counts and fname not in failed:
+            continue
+        page_metrics = sorted(page_metrics_by_pdf.get(fname, []), key=lambda metrics: metrics['page'])
+        metric_records.extend(page_metrics)
+        metric_records.append(get_document_metrics(fname, page_metrics, page_counts.get(fname),
+                                                   prescreen_skipped.get(fname, []), error=failed.get(fname)))
+    run_info = {'time': current_time, 'backend': args.backend, 'dpi': args.dpi, 'max_size': args.max_size,
+                'postfix': postfix, 'words_format': args.words_format, 'workers': args.workers}
+    write_metrics(metric_records, metrics_path, run_info)
+
     print('======== Report ========')
     print(f'Processed {len(pdf_files)} pdf files.')
-    print(f'Successed {len(pdf_files)-len(error_files)} pdf files, Failed {len(error_files)} pdf files.')
+    print(f'Skipped {len(skipped_files)} unchanged pdf files.')
+    print(f'Successed {len(success_files)} pdf files, Failed {len(error_files)} pdf files.')
     print(f'Successed {success_imgs_count} pages.')
+    if args.prescreen_threshold is not None:
+        print(f'Skipped {prescreen_skipped_count} pages without tables by prescreen.')
+    print(f'Metrics written to {metrics_path}.')
 
     with open(root / 'report.txt', 'a') as f:
         f.write('======== Report ========\n')
         f.write(f'Time: {current_time}\n')
         f.write(f'Processed {len(pdf_files)} pdf files.\n')
-        f.write(f'Successed {len(pdf_files)-len(error_files)} pdf files, Failed {len(error_files)} pdf files.\n')
+        f.write(f'Skipped {len(skipped_files)} unchanged pdf files.\n')
+        f.write(f'Successed {len(success_files)} pdf files, Failed {len(error_files)} pdf files.\n')
         f.write(f'Successed {success_imgs_count} pages.\n')
+        if args.prescreen_threshold is not None:
+            f.write(f'Skipped {prescreen_skipped_count} pages without tables by prescreen.\n')
         f.write('========================\n')
         f.write('Successful pdf file list:\n')
         f.write('\n'.join(success_files) + '\n')
         f.write('========================\n')
         f.write('Failed pdf file list:\n')
         f.write('\n'.join(error_files) + '\n')
+        f.write('========================\n')
+        f.write('Skipped pdf file list:\n')
+        f.write('\n'.join(skipped_files) + '\n')
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.append(src_dir)
+sys.path.append(os.path.join(src_dir, '..', 'detr'))
+from inference import TableExtractionPipeline, run_model
+from onnx_backend import OnnxModel, export_onnx
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_type', choices=['detection', 'structure'], required=True)
+    parser.add_argument('--config_path', help='model config, e.g. src/detection_config.json')
+    parser.add_argument('--model_path', help='fp32 model checkpoint')
+    parser.add_argument('--output_path', help='where the .onnx file is saved')
+    parser.add_argument('--opset_version', type=int, default=17)
+    parser.add_argument('--no_verify', action='store_true',
+                        help='skip comparing onnxruntime outputs against torch on a padded batch')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    warnings.filterwarnings('ignore')
+    args = get_args()
+    max_size = 800 if args.data_type == 'detection' else 1000
+
+    if args.data_type == 'detection':
+        model = TableExtractionPipeline(det_device='cpu', det_config_path=args.config_path,
+                                        det_model_path=args.model_path).det_model
+    else:
+        model = TableExtractionPipeline(str_device='cpu', str_config_path=args.config_path,
+                                        str_model_path=args.model_path).str_model
+
+    tic = time.perf_counter()
+    export_onnx(model, args.output_path, max_size=max_size, opset_version=args.opset_version)
+    print(f'Exported {args.output_path} in {time.perf_counter() - tic:.1f}s.')
+    if args.no_verify:
+        sys.exit(0)
+
+    # a portrait and a landscape page in one padded batch, at sizes other than the export example
+    img_tensors = [torch.rand(3, max_size, int(max_size * 0.7)), torch.rand(3, int(max_size * 0.6), max_size)]
+    torch_outputs = run_model(model, img_tensors)
+    onnx_outputs = run_model(OnnxModel(args.output_path), img_tensors)
+    for key in ('pred_logits', 'pred_boxes'):
+        max_diff = np.abs(torch_outputs[key].numpy() - onnx_outputs[key].numpy()).max()
+        print(f'{key}: max abs difference to torch {max_diff:.2e}')
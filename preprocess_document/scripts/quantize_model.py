@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+from PIL import Image
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.append(src_dir)
+sys.path.append(os.path.join(src_dir, '..', 'detr'))
+from inference import TableExtractionPipeline, build_model, detection_transform, structure_transform
+from quantization import quantize_model, save_quantized_model
+from words_format import find_words_file, load_words
+import grits
+
+from benchmark_inference import get_tables, iou
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_type', choices=['detection', 'structure'], required=True)
+    parser.add_argument('--config_path', help='model config, e.g. src/detection_config.json')
+    parser.add_argument('--model_path', help='fp32 model checkpoint')
+    parser.add_argument('--output_path', help='where the quantized checkpoint is saved')
+    parser.add_argument('--calibration_dir', default=None,
+                        help='images to calibrate static backbone quantization on. '
+                             'Without it only the transformer is (dynamically) quantized.')
+    parser.add_argument('--num_calibration_images', type=int, default=32)
+    parser.add_argument('--eval_image_dir', default=None,
+                        help='page images (detection) or table crops (structure) to compare int8 against fp32 on')
+    parser.add_argument('--eval_words_dir', default=None,
+                        help='words files of the structure eval images. Default: eval_image_dir')
+    parser.add_argument('--max_eval_images', type=int, default=50)
+    args = parser.parse_args()
+    return args
+
+def list_images(image_dir, max_images):
+    img_files = sorted(img_file for img_file in os.listdir(image_dir) if img_file.endswith(('.jpg', '.png')))
+    return img_files[:max_images]
+
+def average_precision(reference_pages, pred_pages, iou_threshold=0.5):
+    """
+    AP of the predicted objects, ranked by score, against reference objects (all-point interpolation).
+    """
+    num_reference = sum(len(objects) for objects in reference_pages)
+    if num_reference == 0:
+        return None
+    scored = []
+    for page_idx, objects in enumerate(pred_pages):
+        scored.extend((obj['score'], page_idx, obj) for obj in objects)
+    scored.sort(key=lambda elem: elem[0], reverse=True)
+
+    unmatched = [list(objects) for objects in reference_pages]
+    true_positives = []
+    for _, page_idx, obj in scored:
+        candidates = [(iou(obj['bbox'], ref['bbox']), idx) for idx, ref in enumerate(unmatched[page_idx])
+                      if ref['label'] == obj['label']]
+        best_iou, best_idx = max(candidates) if candidates else (0, None)
+        if best_iou >= iou_threshold:
+            unmatched[page_idx].pop(best_idx)
+            true_positives.append(1)
+        else:
+            true_positives.append(0)
+
+    true_positives = np.cumsum(true_positives)
+    recall = true_positives / num_reference
+    precision = true_positives / np.arange(1, len(true_positives) + 1)
+    # precision envelope, then area under the precision/recall steps
+    recall = np.concatenate([[0], recall, [1]])
+    precision = np.concatenate([[1], precision, [0]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    changes = np.where(recall[1:] != recall[:-1])[0]
+    return float(np.sum((recall[changes + 1] - recall[changes]) * precision[changes + 1]))
+
+def cells_to_grits(true_cells, pred_cells):
+    metrics = {}
+    metrics['grits_top'] = grits.grits_top(np.array(grits.cells_to_relspan_grid(true_cells)),
+                                           np.array(grits.cells_to_relspan_grid(pred_cells)))[0]
+    metrics['grits_loc'] = grits.grits_loc(np.array(grits.cells_to_grid(true_cells, key='bbox')),
+                                           np.array(grits.cells_to_grid(pred_cells, key='bbox')))[0]
+    metrics['grits_con'] = grits.grits_con(np.array(grits.cells_to_grid(true_cells, key='cell text'), dtype=object),
+                                           np.array(grits.cells_to_grid(pred_cells, key='cell text'), dtype=object))[0]
+    return metrics
+
+def evaluate_detection(fp32_pipe, int8_pipe, imgs):
+    latencies = {'fp32': [], 'int8': []}
+    reference_pages, pred_pages = [], []
+    for img in imgs:
+        for name, pipe in (('fp32', fp32_pipe), ('int8', int8_pipe)):
+            tic = time.perf_counter()
+            objects = pipe.detect(img)['objects']
+            latencies[name].append(time.perf_counter() - tic)
+            if name == 'fp32':
+                reference_pages.append(get_tables(objects, pipe.det_class_thresholds))
+            else:
+                pred_pages.append(objects)
+    return {'AP50': average_precision(reference_pages, pred_pages, iou_threshold=0.5),
+            'AP75': average_precision(reference_pages, pred_pages, iou_threshold=0.75)}, latencies
+
+def evaluate_structure(fp32_pipe, int8_pipe, imgs, tokens):
+    latencies = {'fp32': [], 'int8': []}
+    sample_metrics = []
+    for img, img_tokens in zip(imgs, tokens):
+        cells = {}
+        for name, pipe in (('fp32', fp32_pipe), ('int8', int8_pipe)):
+            tic = time.perf_counter()
+            tables_cells = pipe.recognize(img, tokens=img_tokens, out_cells=True)['cells']
+            latencies[name].append(time.perf_counter() - tic)
+            cells[name] = tables_cells[0] if len(tables_cells) > 0 else []
+        # crops where the fp32 model finds no table have no reference to compare against
+        if len(cells['fp32']) > 0:
+            sample_metrics.append(cells_to_grits(cells['fp32'], cells['int8']))
+    metrics = {key: float(np.mean([elem[key] for elem in sample_metrics])) if sample_metrics else None
+               for key in ('grits_top', 'grits_loc', 'grits_con')}
+    metrics['tables'] = len(sample_metrics)
+    return metrics, latencies
+
+if __name__ == "__main__":
+    warnings.filterwarnings('ignore')
+    args = get_args()
+    transform = detection_transform if args.data_type == 'detection' else structure_transform
+    input_size = (800, 800) if args.data_type == 'detection' else (1000, 1000)
+
+    with open(args.config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    model_args = type('Args', (object,), config)
+    model_args.device = 'cpu'
+    model, _, _ = build_model(model_args)
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    if 'model_state_dict' in checkpoint:
+        checkpoint = checkpoint['model_state_dict']
+    model.load_state_dict(checkpoint, strict=False)
+
+    calibration_tensors = None
+    if not args.calibration_dir is None:
+        calibration_files = list_images(args.calibration_dir, args.num_calibration_images)
+        calibration_tensors = [transform(Image.open(os.path.join(args.calibration_dir, img_file)).convert('RGB'))
+                               for img_file in calibration_files]
+        print(f'Calibrating the backbone on {len(calibration_tensors)} images.')
+    quantize_model(model, calibration_tensors, input_size=input_size)
+    save_quantized_model(model, args.output_path)
+    print(f'Quantized model saved to {args.output_path} '
+          f'({os.path.getsize(args.model_path) / 1e6:.1f}MB -> {os.path.getsize(args.output_path) / 1e6:.1f}MB).')
+
+    if args.eval_image_dir is None:
+        sys.exit(0)
+
+    if args.data_type == 'detection':
+        fp32_pipe = TableExtractionPipeline(det_device='cpu', det_config_path=args.config_path,
+                                            det_model_path=args.model_path)
+        int8_pipe = TableExtractionPipeline(det_device='cpu', det_config_path=args.config_path,
+                                            det_model_path=args.output_path)
+    else:
+        fp32_pipe = TableExtractionPipeline(str_device='cpu', str_config_path=args.config_path,
+                                            str_model_path=args.model_path)
+        int8_pipe = TableExtractionPipeline(str_device='cpu', str_config_path=args.config_path,
+                                            str_model_path=args.output_path)
+
+    eval_files = list_images(args.eval_image_dir, args.max_eval_images)
+    imgs = [Image.open(os.path.join(args.eval_image_dir, img_file)).convert('RGB') for img_file in eval_files]
+    if args.data_type == 'detection':
+        metrics, latencies = evaluate_detection(fp32_pipe, int8_pipe, imgs)
+    else:
+        words_dir = args.eval_words_dir or args.eval_image_dir
+        tokens = []
+        for img_file in eval_files:
+            words_path = find_words_file(words_dir, os.path.splitext(img_file)[0])
+            tokens.append(load_words(words_path) if not words_path is None else [])
+        metrics, latencies = evaluate_structure(fp32_pipe, int8_pipe, imgs, tokens)
+
+    print('======== int8 vs fp32 ========')
+    print(f'{len(imgs)} images, fp32 outputs as reference')
+    for key, val in metrics.items():
+        print(f'{key:>10}: {val:.4f}' if isinstance(val, float) else f'{key:>10}: {val}')
+    fp32_latency, int8_latency = np.mean(latencies['fp32']), np.mean(latencies['int8'])
+    print(f'   latency: fp32 {fp32_latency:.3f}s, int8 {int8_latency:.3f}s, {fp32_latency / int8_latency:.2f}x')
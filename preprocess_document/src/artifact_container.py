@@ -0,0 +1,240 @@
+"""
+Per-document artifact container.
+
+Instead of writing one small file per page and per table, all outputs of a document
+(detection objects, table crops and words, cells, html, ...) are stored in a single
+{document}.artifacts file under the output directory. Each artifact keeps the relative path
+it would have had as a separate file, e.g. 'detection/sample_page3_objects.json', as its key.
+
+File layout:
+    records : artifact bytes back to back, each optionally zstd compressed
+    index   : UTF-8 JSON {key: [offset, length, compressed]}
+    footer  : index offset (uint64), index length (uint64), magic b'TATRPACK'
+
+The index is read once when a container is opened, so any artifact can be read
+with a single seek. Reopening a container for writing appends new records, a new index and footer
+after the old footer, which stays valid until then. If a run dies before closing the container, the
+records it appended have no footer yet; the last valid footer is then found by scanning back and
+everything written before it is kept. A file without any valid footer holds nothing readable and is
+started over.
+"""
+import json
+import os
+import re
+import struct
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'TATRPACK'
+FOOTER = struct.Struct('<QQ8s')
+CONTAINER_SUFFIX = '.artifacts'
+# already compressed formats are stored as they are
+UNCOMPRESSED_EXTENSIONS = ('.png', '.jpg')
+
+
+def get_document_name(file_name):
+    """
+    Document an output file belongs to: 'sample_page3_table_1.png' -> 'sample'.
+    Files which do not follow the {document}_page{n} naming belong to a document of their own stem.
+    """
+    base_name = os.path.basename(file_name)
+    match = re.match(r'^(.*)_page\d+', base_name)
+    if match is not None:
+        return match.group(1)
+    return os.path.splitext(base_name)[0]
+
+
+def read_footer(f, footer_end):
+    """
+    output: (index, index offset) of the footer ending at footer_end, or None if there is no valid one
+    """
+    if footer_end < FOOTER.size:
+        return None
+    f.seek(footer_end - FOOTER.size)
+    index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != MAGIC or index_offset + index_length != footer_end - FOOTER.size:
+        return None
+    f.seek(index_offset)
+    try:
+        index = json.loads(f.read(index_length).decode('utf-8'))
+    except ValueError:
+        return None
+    return index, index_offset
+
+
+def find_footer_end(f, file_size, chunk_size=1 << 20):
+    """
+    Scan back from the end of the file for the last valid footer; records appended after it
+    by a run that died before close() are not indexed.
+    """
+    end = file_size
+    while end > 0:
+        start = max(0, end - chunk_size)
+        f.seek(start)
+        # overlap the chunks so a magic split between two of them is found
+        data = f.read(min(end + len(MAGIC) - 1, file_size) - start)
+        pos = data.rfind(MAGIC)
+        while pos >= 0:
+            footer_end = start + pos + len(MAGIC)
+            if read_footer(f, footer_end) is not None:
+                return footer_end
+            pos = data.rfind(MAGIC, 0, pos + len(MAGIC) - 1)
+        end = start
+    return None
+
+
+def read_index(f):
+    """
+    output: (index, end of its footer); raises ValueError if f has no valid footer
+    """
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    footer_end = file_size
+    footer = read_footer(f, file_size)
+    if footer is None:
+        footer_end = find_footer_end(f, file_size)
+        if footer_end is None:
+            raise ValueError(f'{f.name} is not an artifact container')
+        footer = read_footer(f, footer_end)
+    return footer[0], footer_end
+
+
+class ContainerWriter(object):
+    """
+    Write artifacts of one document into a container file. An existing container is appended to;
+    an artifact written again under the same key replaces the old one in the index.
+    """
+    def __init__(self, path, compress_level=None):
+        if compress_level is not None and zstandard is None:
+            raise ImportError('zstandard is required for compressed artifact containers: pip install zstandard')
+        self.path = path
+        self.compressor = zstandard.ZstdCompressor(level=compress_level) if compress_level is not None else None
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, 'r+b')
+            try:
+                self.index, data_end = read_index(self.file)
+            except ValueError:
+                # no footer at all: a run died before its first close(). Records carry no headers, so
+                # nothing in the file is readable and the container is started over
+                print(f'{path} has no valid index, probably left by an interrupted run. Starting it over.')
+                self.index, data_end = {}, 0
+            # only drops records a crashed run appended after the last valid footer; the old index and
+            # footer stay in place, so the container remains readable until close() writes new ones
+            self.file.truncate(data_end)
+            self.file.seek(data_end)
+        else:
+            self.file = open(path, 'wb')
+            self.index = {}
+
+    def put(self, key, data):
+        compressed = self.compressor is not None and not key.endswith(UNCOMPRESSED_EXTENSIONS)
+        if compressed:
+            data = self.compressor.compress(data)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index[key] = [offset, len(data), compressed]
+
+    def close(self):
+        if self.file is None:
+            return
+        index_offset = self.file.tell()
+        index = json.dumps(self.index, ensure_ascii=False).encode('utf-8')
+        self.file.write(index)
+        self.file.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ContainerReader(object):
+    """
+    Random access to the artifacts of one container file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.index, _ = read_index(self.file)
+        self.decompressor = None
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        offset, length, compressed = self.index[key]
+        self.file.seek(offset)
+        data = self.file.read(length)
+        if compressed:
+            if zstandard is None:
+                raise ImportError('zstandard is required to read compressed artifacts: pip install zstandard')
+            if self.decompressor is None:
+                self.decompressor = zstandard.ZstdDecompressor()
+            data = self.decompressor.decompress(data)
+        return data
+
+    def get_json(self, key):
+        return json.loads(self.get(key).decode('utf-8'))
+
+    def get_text(self, key):
+        return self.get(key).decode('utf-8')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ContainerSet(object):
+    """
+    Route output files under root_dir into one container per document.
+    At most max_open containers are kept open; the least recently used one is closed
+    (and reopened for appending if the document shows up again).
+    """
+    def __init__(self, root_dir, compress_level=None, max_open=32):
+        self.root_dir = root_dir
+        self.compress_level = compress_level
+        self.max_open = max_open
+        self.writers = OrderedDict()
+
+    def get_path(self, document):
+        return os.path.join(self.root_dir, document + CONTAINER_SUFFIX)
+
+    def write(self, out_path, data):
+        """
+        out_path: the path the artifact would have been written to as a separate file
+        """
+        key = os.path.relpath(out_path, self.root_dir).replace(os.sep, '/')
+        document = get_document_name(key)
+        writer = self.writers.pop(document, None)
+        if writer is None:
+            writer = ContainerWriter(self.get_path(document), compress_level=self.compress_level)
+            if len(self.writers) >= self.max_open:
+                _, oldest = self.writers.popitem(last=False)
+                oldest.close()
+        self.writers[document] = writer
+        writer.put(key, data)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+    def __deepcopy__(self, memo):
+        # args namespaces holding a ContainerSet are deep-copied per stage; they all share the same writers
+        return self
@@ -0,0 +1,143 @@
+"""
+Background writer for the output files of inference.py.
+
+output_result hands every output file to an ArtifactWriter as a path and either its bytes or a function
+returning them (PNG crops and matplotlib figures are encoded lazily). Writer threads encode and write
+them, so the inference loop only enqueues; at most max_pending files are in flight, after which
+submit blocks until the threads catch up. Each thread has its own queue and all files of one path go
+to the same thread, so a path written more than once (e.g. _cells.json of every table of a page) ends
+up with the last submitted data, as when writing synchronously.
+
+With fsync_every > 0, written files are fsync'ed in batches of that many files (plus their directories),
+instead of not at all or once per file. flush() is a barrier: it waits for every submitted file to be
+written and fsyncs the rest of the batch. It must be called before artifact containers are closed.
+
+Artifact containers (artifact_container.py) are not thread-safe, so writes into them are serialized;
+encoding still runs in the writer threads. Files written into containers are never fsync'ed.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ArtifactWriter(object):
+    """
+    workers: threads encoding and writing files; 0 writes synchronously in the calling thread
+    fsync_every: fsync written files in batches of this many; 0 never fsyncs
+    max_pending: files submitted but not yet written before submit blocks
+    """
+    def __init__(self, workers=2, fsync_every=0, max_pending=64):
+        # one single-threaded executor per thread keeps the writes of a path in submission order
+        self.executors = [ThreadPoolExecutor(1, thread_name_prefix='writer') for _ in range(workers)]
+        self.workers = workers
+        self.fsync_every = fsync_every
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = set()
+        self.lock = threading.Lock()
+        self.container_lock = threading.Lock()
+        self.unsynced = []
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.fsyncs = 0
+        self.write_time = 0.0
+        self.fsync_time = 0.0
+
+    def submit(self, out_path, data, container=None):
+        """
+        data: bytes, or a function returning them, called in a writer thread
+        container: ContainerSet to write into instead of out_path
+        """
+        if len(self.executors) == 0:
+            self.write(out_path, data, container)
+            return
+        self.pending.acquire()
+        executor = self.executors[hash(out_path) % len(self.executors)]
+        future = executor.submit(self.write, out_path, data, container)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.pending.release()
+
+    def write(self, out_path, data, container=None):
+        tic = time.perf_counter()
+        try:
+            if callable(data):
+                data = data()
+            if container is not None:
+                with self.container_lock:
+                    container.write(out_path, data)
+            else:
+                with open(out_path, 'wb') as f:
+                    f.write(data)
+        except Exception as e:
+            print(f'while writing {out_path}, got error: {e}.')
+            with self.lock:
+                self.errors += 1
+            return
+        batch = None
+        with self.lock:
+            self.files += 1
+            self.bytes += len(data)
+            self.write_time += time.perf_counter() - tic
+            if self.fsync_every > 0 and container is None:
+                self.unsynced.append(out_path)
+                if len(self.unsynced) >= self.fsync_every:
+                    batch, self.unsynced = self.unsynced, []
+        if batch is not None:
+            self.fsync(batch)
+
+    def fsync(self, paths):
+        tic = time.perf_counter()
+        dirs = set()
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            dirs.add(os.path.dirname(path) or '.')
+        # new directory entries are only durable once the directory is synced too
+        for path in dirs:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        with self.lock:
+            self.fsyncs += 1
+            self.fsync_time += time.perf_counter() - tic
+
+    def flush(self):
+        """
+        Wait until every submitted file is written, then fsync the unfinished batch.
+        """
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+            if len(futures) == 0:
+                break
+            for future in futures:
+                future.result()
+        with self.lock:
+            batch, self.unsynced = self.unsynced, []
+        if len(batch) > 0:
+            self.fsync(batch)
+
+    def close(self):
+        self.flush()
+        for executor in self.executors:
+            executor.shutdown()
+
+    def summary(self):
+        return {'workers': self.workers, 'files': self.files, 'bytes': self.bytes, 'errors': self.errors,
+                'fsyncs': self.fsyncs, 'write_time': self.write_time, 'fsync_time': self.fsync_time}
+
+    def __deepcopy__(self, memo):
+        # args namespaces holding the writer are deep-copied per stage; they all share the same threads
+        return self
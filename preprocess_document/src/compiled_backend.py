@@ -0,0 +1,98 @@
+"""
+Compiled execution of the DETR models on a fixed set of input shapes.
+
+MaxResize produces a different input shape for almost every page, and compiled graphs are
+specialized to their input shape. CompiledModel therefore pads every batch up to one of a few
+canonical shape buckets: the extra pixels are marked as padding in the NestedTensor mask, exactly
+like the padding nested_tensor_from_tensor_list adds for batching, and the batch itself is filled
+up to batch_size with blank pages whose outputs are dropped. Each bucket is compiled once.
+
+    inductor   : torch.compile with static shapes
+    torchscript: torch.jit.trace, frozen and optimized for inference, one trace per bucket
+"""
+import torch
+from torch import nn
+
+from onnx_backend import ExportWrapper
+
+COMPILE_MODES = ('inductor', 'torchscript')
+
+
+def get_shape_buckets(max_size=800, step=160):
+    """
+    Canonical (height, width) shapes for images resized to a longest side of max_size:
+    the longest side is max_size, the other side a multiple of step (or max_size).
+
+    output: list of (height, width), smallest area first
+    """
+    short_sides = sorted(set(list(range(step, max_size, step)) + [max_size]))
+    buckets = set()
+    for short_side in short_sides:
+        buckets.add((max_size, short_side))
+        buckets.add((short_side, max_size))
+    return sorted(buckets, key=lambda bucket: (bucket[0] * bucket[1], bucket))
+
+
+def pick_bucket(height, width, buckets):
+    """
+    output: the smallest bucket an image of height x width fits in, or None
+    """
+    for bucket in buckets:
+        if bucket[0] >= height and bucket[1] >= width:
+            return bucket
+    return None
+
+
+class CompiledModel(nn.Module):
+    """
+    Wrap a DETR model so every forward runs on one of its shape buckets.
+    Inputs larger than every bucket, or batches larger than batch_size, fall back to the eager model.
+    extra_sizes: further longest sides inputs are resized to (e.g. a cascade size), each with buckets of its own
+    """
+    def __init__(self, model, mode='inductor', max_size=800, step=160, batch_size=1, extra_sizes=()):
+        super().__init__()
+        if not mode in COMPILE_MODES:
+            raise ValueError(f'Unknown compile mode {mode}, expected one of {COMPILE_MODES}')
+        self.model = model
+        self.mode = mode
+        self.batch_size = batch_size
+        buckets = set(get_shape_buckets(max_size, step))
+        for size in extra_sizes:
+            buckets.update(get_shape_buckets(size, step))
+        self.buckets = sorted(buckets, key=lambda bucket: (bucket[0] * bucket[1], bucket))
+        self.wrapper = ExportWrapper(model).eval()
+        self.compiled = {}
+        if mode == 'inductor':
+            # every bucket is a recompilation of the same forward
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit,
+                                                        2 * len(self.buckets))
+            self.compiled_wrapper = torch.compile(self.wrapper, dynamic=False)
+
+    def get_compiled(self, bucket, images, mask):
+        if self.mode == 'inductor':
+            return self.compiled_wrapper
+        if not bucket in self.compiled:
+            with torch.no_grad():
+                traced = torch.jit.trace(self.wrapper, (images.clone(), mask.clone()), check_trace=False)
+                self.compiled[bucket] = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        return self.compiled[bucket]
+
+    def forward(self, samples):
+        images, mask = samples.decompose()
+        batch_size, _, height, width = images.shape
+        bucket = pick_bucket(height, width, self.buckets)
+        if bucket is None or batch_size > self.batch_size:
+            return self.model(samples)
+
+        padded_images = images.new_zeros((self.batch_size, images.shape[1]) + bucket)
+        padded_images[:batch_size, :, :height, :width].copy_(images)
+        if images.is_contiguous(memory_format=torch.channels_last):
+            padded_images = padded_images.contiguous(memory_format=torch.channels_last)
+        # blank filler pages are left unmasked, so no attention row is fully masked
+        padded_mask = mask.new_zeros((self.batch_size,) + bucket)
+        padded_mask[:batch_size, :height, :width].copy_(mask)
+        padded_mask[:batch_size, height:, :] = True
+        padded_mask[:batch_size, :, width:] = True
+
+        pred_logits, pred_boxes = self.get_compiled(bucket, padded_images, padded_mask)(padded_images, padded_mask)
+        return {'pred_logits': pred_logits[:batch_size], 'pred_boxes': pred_boxes[:batch_size]}
@@ -6,11 +6,15 @@ import xml.etree.ElementTree as ET
 import os
 import random
 import io
+import re
+import threading
 from copy import deepcopy
+from functools import partial
 
 import torch
 from torchvision import transforms
 from PIL import Image
+import fitz
 from fitz import Rect
 import numpy as np
 import pandas as pd
@@ -21,8 +25,16 @@ import time
 
 from main import get_model
 import postprocess
+from words_format import find_words_file, load_words
+from artifact_container import ContainerSet
+from artifact_writer import ArtifactWriter
 sys.path.append("detr")
 from models import build_model
+from models.detr import EarlyExit, TokenPruning, enable_early_exit, enable_token_pruning, optimize_for_inference
+from util.misc import NestedTensor, nested_tensor_from_tensor_list
+from quantization import is_quantized_checkpoint, load_quantized_model, quantize_model
+from onnx_backend import OnnxModel
+from compiled_backend import COMPILE_MODES, CompiledModel
 
 class MaxResize(object):
     def __init__(self, max_size=800):
@@ -36,18 +48,80 @@ class MaxResize(object):
         
         return resized_image
 
+detection_transform_size = 800
+structure_transform_size = 1000
+
 detection_transform = transforms.Compose([
-    MaxResize(800),
+    MaxResize(detection_transform_size),
     transforms.ToTensor(),
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
 structure_transform = transforms.Compose([
-    MaxResize(1000),
+    MaxResize(structure_transform_size),
     transforms.ToTensor(),
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
+def find_content_bbox(img, max_size=512, ink_threshold=40, min_ink=2, padding=0.02):
+    """
+    Bounding box of the content of a page, from the row and column projection profiles of a grayscale
+    copy downsampled to max_size. A pixel is ink when it is darker than the page background (the median
+    gray level) by more than ink_threshold, and a row or column holds content when it has at least
+    min_ink ink pixels. The box is padded by padding times the longest page side.
+
+    output: [x0, y0, x1, y1] in img pixel coordinates, or None for a blank page
+    """
+    width, height = img.size
+    # box-filter downsampling by an integer factor, then grayscale on the small copy
+    factor = int(np.ceil(max(width, height) / max_size))
+    gray = (img.reduce(factor) if factor > 1 else img).convert('L')
+    pixels = np.asarray(gray, dtype=np.int16)
+    ink = pixels < np.median(pixels) - ink_threshold
+    rows = np.nonzero(ink.sum(1) >= min_ink)[0]
+    cols = np.nonzero(ink.sum(0) >= min_ink)[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+
+    scale_x, scale_y = gray.width / width, gray.height / height
+    pad = padding * max(width, height)
+    return [max(0, int(cols[0] / scale_x - pad)), max(0, int(rows[0] / scale_y - pad)),
+            min(width, int(np.ceil((cols[-1] + 1) / scale_x + pad))),
+            min(height, int(np.ceil((rows[-1] + 1) / scale_y + pad)))]
+
+def get_detection_transform(max_size):
+    return transforms.Compose([
+        MaxResize(max_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+def cascade_decision(objects, img_size, class_thresholds, transform_size, score_margin=0.15, min_box_size=64):
+    """
+    Decide whether the low-resolution detections of a page can be kept, or the page needs the
+    full-resolution pass: any object scoring within score_margin of its class threshold is borderline,
+    and any accepted object with a side shorter than min_box_size pixels at transform_size is too small.
+
+    output: list of reasons to re-run the page ('borderline', 'small'); empty to keep the low-resolution result
+    """
+    scale = transform_size / max(img_size)
+    reasons = set()
+    for obj in objects:
+        threshold = class_thresholds[obj['label']]
+        if abs(obj['score'] - threshold) < score_margin:
+            reasons.add('borderline')
+        elif obj['score'] >= threshold:
+            bbox = obj['bbox']
+            if min(bbox[2] - bbox[0], bbox[3] - bbox[1]) * scale < min_box_size:
+                reasons.add('small')
+    return sorted(reasons)
+
+def shift_objects(objects, x_offset, y_offset):
+    for obj in objects:
+        obj['bbox'] = [obj['bbox'][0] + x_offset, obj['bbox'][1] + y_offset,
+                       obj['bbox'][2] + x_offset, obj['bbox'][3] + y_offset]
+    return objects
+
 def get_class_map(data_type):
     if data_type == 'structure':
         class_map = {
@@ -115,6 +189,96 @@ def get_args():
                         help='Visualize output')
     parser.add_argument('--crop_padding', type=int, default=10,
                         help="The amount of padding to add around a detected table when cropping.")
+    parser.add_argument('--pdf_dir',
+                        help="Directory for the source PDFs of the input images. If given in extract mode, "
+                             "detected tables are re-rendered from the PDF at structure model resolution "
+                             "instead of cropped from the page image.")
+    parser.add_argument('--structure_max_size', type=int, default=1000,
+                        help="Longest side in pixels of table crops re-rendered from the PDF.")
+    parser.add_argument('--artifact_container', action='store_true',
+                        help="Write all outputs of a document into one {document}.artifacts file in out_dir "
+                             "instead of one file per page and table.")
+    parser.add_argument('--zstd_level', type=int, default=None,
+                        help="zstd compression level for artifact containers. Default: no compression.")
+    parser.add_argument('--async_writer', action='store_true',
+                        help="Encode and write output files in background threads (see artifact_writer.py), "
+                             "so the inference loop only enqueues them.")
+    parser.add_argument('--writer_threads', type=int, default=2,
+                        help="Threads of the background writer.")
+    parser.add_argument('--fsync_every', type=int, default=0,
+                        help="fsync written files in batches of this many, and the rest at the end of the run. "
+                             "Default: no fsync.")
+    parser.add_argument('--compact_json', action='store_true',
+                        help="Write JSON outputs without indentation or whitespace.")
+    parser.add_argument('--png_compress_level', type=int, default=None, choices=range(10),
+                        help="zlib level (0-9) of PNG crops and figures. Default: PIL's own (6).")
+    parser.add_argument('--detection_batch_size', type=int, default=1,
+                        help="Number of pages run through the detection model at once in detect mode. "
+                             "Pages are grouped by aspect ratio to keep padding small.")
+    parser.add_argument('--structure_batch_size', type=int, default=1,
+                        help="Number of table crops of a page run through the structure model at once "
+                             "in extract mode.")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="Run the models in channels_last memory format (faster ResNet convolutions on CPU).")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Run the models under bfloat16 autocast.")
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help="Number of intra-op threads torch uses. Default: torch's own choice.")
+    parser.add_argument('--backend', choices=['torch', 'onnxruntime', 'inductor', 'torchscript'], default='torch',
+                        help="onnxruntime runs ONNX models exported by scripts/export_onnx.py on CPU; "
+                             "pass the .onnx files as --detection_model_path/--structure_model_path. "
+                             "inductor (torch.compile) and torchscript compile the models for a set of padded "
+                             "input shapes at startup.")
+    parser.add_argument('--compile_step', type=int, default=160,
+                        help="Shape bucket granularity in pixels for the compiled backends. Smaller steps waste "
+                             "less compute on padding but compile more buckets.")
+    parser.add_argument('--quantize', action='store_true',
+                        help="Apply dynamic int8 quantization to the transformer of both models (CPU only). "
+                             "Checkpoints saved by scripts/quantize_model.py are loaded quantized without this flag.")
+    parser.add_argument('--early_exit', action='store_true',
+                        help="Stop the decoder of both models after the first layer whose predictions have "
+                             "converged (torch backend only). Exit statistics are printed at the end.")
+    parser.add_argument('--early_exit_min_layers', type=int, default=2,
+                        help="Decoder layers always run with --early_exit.")
+    parser.add_argument('--early_exit_class_agreement', type=float, default=1.0,
+                        help="Share of queries that must keep their class from one decoder layer to the next.")
+    parser.add_argument('--early_exit_box_delta', type=float, default=0.01,
+                        help="Largest change of a normalized box coordinate of a predicted object "
+                             "from one decoder layer to the next.")
+    parser.add_argument('--early_exit_min_confidence', type=float, default=0.5,
+                        help="Smallest class probability any query may have.")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Run loading, model forwards, structure post-processing and writing as concurrent "
+                             "stages connected by bounded queues (see pipeline_runner.py). Stage utilization and "
+                             "queue depths are printed at the end.")
+    parser.add_argument('--loader_threads', type=int, default=4,
+                        help="Threads loading images and words files with --pipelined.")
+    parser.add_argument('--postprocess_workers', type=int, default=2,
+                        help="Processes turning structure objects into cells, HTML and CSV with --pipelined. "
+                             "0 runs them in one background thread.")
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help="Capacity of the queues between the --pipelined stages.")
+    parser.add_argument('--cascade_size', type=int, default=None,
+                        help="Cascade detection: detect at this max size (e.g. 512) first, and re-run at 800 only "
+                             "pages with borderline scores or small tables. Decisions are written to "
+                             "cascade_decisions.jsonl in out_dir. Default: no cascade.")
+    parser.add_argument('--cascade_score_margin', type=float, default=0.15,
+                        help="Low-resolution detections scoring within this margin of their class threshold "
+                             "are borderline.")
+    parser.add_argument('--cascade_min_box_size', type=int, default=64,
+                        help="Tables with a side shorter than this (in pixels at --cascade_size) are re-run "
+                             "at full resolution.")
+    parser.add_argument('--crop_margins', action='store_true',
+                        help="Crop page margins (found from projection profiles) before detection, so the "
+                             "detection model sees the content at a higher resolution.")
+    parser.add_argument('--token_pruning', action='store_true',
+                        help="Leave feature locations over blank image areas out of the transformer of both "
+                             "models (torch backend only). The share of tokens kept is printed at the end.")
+    parser.add_argument('--token_pruning_blank_range', type=float, default=0.5,
+                        help="An image patch is blank when the range of its normalized pixel values stays "
+                             "below this on every channel.")
+    parser.add_argument('--token_pruning_margin', type=int, default=1,
+                        help="Blank feature locations within this many cells of content are kept.")
 
     return parser.parse_args()
 
@@ -249,6 +413,58 @@ def outputs_to_objects(outputs, img_size, class_idx2name):
 
     return objects
 
+def split_batch_outputs(outputs):
+    """
+    Split the outputs of a batched forward pass into per-image outputs with a batch dimension of 1,
+    so outputs_to_objects can be applied to each of them.
+    """
+    batch_size = outputs['pred_logits'].shape[0]
+    return [{'pred_logits': outputs['pred_logits'][idx:idx+1], 'pred_boxes': outputs['pred_boxes'][idx:idx+1]}
+            for idx in range(batch_size)]
+
+
+def run_model(model, img_tensors, channels_last=False, autocast_dtype=None):
+    """
+    Pad a list of image tensors into one masked batch and run it through a DETR model in inference mode.
+    model can also be an onnx_backend.OnnxModel; the torch execution options do not apply to it.
+
+    channels_last: lay the batch out in NHWC memory format, to match a model converted to channels_last
+    autocast_dtype: e.g. torch.bfloat16 to run the forward under autocast. Outputs are returned in float32.
+    """
+    if isinstance(model, OnnxModel):
+        return model(nested_tensor_from_tensor_list(img_tensors))
+
+    device = next(model.parameters()).device
+    samples = nested_tensor_from_tensor_list([img_tensor.to(device) for img_tensor in img_tensors])
+    if channels_last:
+        samples = NestedTensor(samples.tensors.contiguous(memory_format=torch.channels_last), samples.mask)
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=autocast_dtype,
+                                                enabled=autocast_dtype is not None):
+        outputs = model(samples)
+    return {'pred_logits': outputs['pred_logits'].float(), 'pred_boxes': outputs['pred_boxes'].float()}
+
+
+def batch_by_aspect_ratio(img_sizes, batch_size, max_aspect_ratio_gap=0.1):
+    """
+    Group images into batches of similar aspect ratio, so little of each padded batch is padding.
+    Images are sorted by aspect ratio (height / width) and a new batch is started when the batch is full
+    or when an image's aspect ratio exceeds the first one in the batch by more than max_aspect_ratio_gap.
+
+    img_sizes: list of (width, height)
+    output: list of batches, each a list of indices into img_sizes
+    """
+    order = sorted(range(len(img_sizes)), key=lambda idx: img_sizes[idx][1] / img_sizes[idx][0])
+    batches = []
+    for idx in order:
+        aspect_ratio = img_sizes[idx][1] / img_sizes[idx][0]
+        if (len(batches) == 0 or len(batches[-1]) >= batch_size
+                or aspect_ratio - batch_aspect_ratio > max_aspect_ratio_gap):
+            batches.append([])
+            batch_aspect_ratio = aspect_ratio
+        batches[-1].append(idx)
+    return batches
+
+
 def objects_to_crops(img, tokens, objects, class_thresholds, padding=10):
     """
     Process the bounding boxes produced by the table detection model into
@@ -277,14 +493,7 @@ def objects_to_crops(img, tokens, objects, class_thresholds, padding=10):
 
         # If table is predicted to be rotated, rotate cropped image and tokens/words:
         if obj['label'] == 'table rotated':
-            cropped_img = cropped_img.rotate(270, expand=True)
-            for token in table_tokens:
-                bbox = token['bbox']
-                bbox = [cropped_img.size[0]-bbox[3]-1,
-                        bbox[0],
-                        cropped_img.size[0]-bbox[1]-1,
-                        bbox[2]]
-                token['bbox'] = bbox
+            cropped_img = rotate_crop(cropped_img, table_tokens)
 
         cropped_table['image'] = cropped_img
         cropped_table['tokens'] = table_tokens
@@ -293,6 +502,101 @@ def objects_to_crops(img, tokens, objects, class_thresholds, padding=10):
 
     return table_crops
 
+def rotate_crop(cropped_img, table_tokens):
+    """
+    Rotate a cropped table image by 270 degrees and its tokens/words in place to match.
+    """
+    cropped_img = cropped_img.rotate(270, expand=True)
+    for token in table_tokens:
+        bbox = token['bbox']
+        bbox = [cropped_img.size[0]-bbox[3]-1,
+                bbox[0],
+                cropped_img.size[0]-bbox[1]-1,
+                bbox[2]]
+        token['bbox'] = bbox
+    return cropped_img
+
+def objects_to_pdf_crops(page, img_size, objects, class_thresholds, padding=10, max_size=1000):
+    """
+    Same as objects_to_crops, but each table region is re-rendered from the PDF page
+    with its longest side at max_size pixels, instead of cropped from the page image.
+    This lets the page be rendered only at detection resolution.
+    Tokens are taken from the PDF words and scaled to the re-rendered crop.
+
+    page: fitz.Page the page image was rendered from
+    img_size: (width, height) of the page image the objects were detected on
+    padding: in pixels at 300 DPI (the default page image resolution), so a table gets the same margin
+             in the PDF however small the page image was rendered
+    """
+    page_rect = page.rect
+    scale_x = page_rect.width / img_size[0]
+    scale_y = page_rect.height / img_size[1]
+    padding = padding * 72 / 300
+    page_words = page.get_text_words()
+
+    table_crops = []
+    objects = sorted(objects, key=lambda x: (x['bbox'][1]+(x['bbox'][3]-x['bbox'][1])/2, x['bbox'][0]+(x['bbox'][2]-x['bbox'][0])/2))
+    for obj in objects:
+        if obj['score'] < class_thresholds[obj['label']]:
+            continue
+
+        cropped_table = {}
+
+        bbox = obj['bbox']
+        clip = Rect(page_rect.x0 + bbox[0]*scale_x - padding, page_rect.y0 + bbox[1]*scale_y - padding,
+                    page_rect.x0 + bbox[2]*scale_x + padding, page_rect.y0 + bbox[3]*scale_y + padding) & page_rect
+        if clip.is_empty:
+            continue
+
+        zoom = max_size / max(clip.width, clip.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        cropped_img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+        table_tokens = []
+        for span_num, word in enumerate(page_words):
+            if iob(word[:4], clip) < 0.5:
+                continue
+            table_tokens.append({'bbox': [(word[0]-clip.x0)*zoom,
+                                          (word[1]-clip.y0)*zoom,
+                                          (word[2]-clip.x0)*zoom,
+                                          (word[3]-clip.y0)*zoom],
+                                 'text': word[4],
+                                 'flags': 0,
+                                 'span_num': span_num,
+                                 'line_num': word[6],
+                                 'block_num': word[5]})
+
+        # If table is predicted to be rotated, rotate cropped image and tokens/words:
+        if obj['label'] == 'table rotated':
+            cropped_img = rotate_crop(cropped_img, table_tokens)
+
+        cropped_table['image'] = cropped_img
+        cropped_table['tokens'] = table_tokens
+
+        table_crops.append(cropped_table)
+
+    return table_crops
+
+def load_pdf_page(pdf_dir, img_file):
+    """
+    Open the PDF page an image was rendered from. Images are expected to be named
+    {pdf name}_page{page number}{postfix}, as written by scripts/convert_pdf_to_image.py.
+
+    output: (fitz.Document, fitz.Page), or (None, None) if there is no matching PDF page
+    """
+    match = re.match(r'^(.*)_page(\d+)\.(jpg|png)$', img_file)
+    if match is None:
+        return None, None
+    pdf_path = os.path.join(pdf_dir, match.group(1) + '.pdf')
+    if not os.path.exists(pdf_path):
+        return None, None
+    doc = fitz.open(pdf_path)
+    page_num = int(match.group(2))
+    if page_num > doc.page_count:
+        doc.close()
+        return None, None
+    return doc, doc[page_num - 1]
+
 def objects_to_structures(objects, tokens, class_thresholds):
     """
     Process the bounding boxes produced by the table structure recognition model into
@@ -584,7 +888,7 @@ def cells_to_html(cells):
     return html_string
     # return str(ET.tostring(table, encoding="unicode", short_empty_elements=False))
 
-def visualize_detected_tables(img, det_tables, out_path):
+def visualize_detected_tables(img, det_tables, out_path, fig_format=None, pil_kwargs=None):
     plt.imshow(img, interpolation="lanczos")
     plt.gcf().set_size_inches(20, 20)
     ax = plt.gca()
@@ -628,12 +932,12 @@ def visualize_detected_tables(img, det_tables, out_path):
                     fontsize=10, ncol=2)  
     plt.gcf().set_size_inches(10, 10)
     plt.axis('off')
-    plt.savefig(out_path, bbox_inches='tight', dpi=150)
+    plt.savefig(out_path, bbox_inches='tight', dpi=150, format=fig_format, pil_kwargs=pil_kwargs)
     plt.close()
 
     return
 
-def visualize_cells(img, cells, out_path):
+def visualize_cells(img, cells, out_path, fig_format=None, pil_kwargs=None):
     plt.imshow(img, interpolation="lanczos")
     plt.gcf().set_size_inches(20, 20)
     ax = plt.gca()
@@ -683,19 +987,102 @@ def visualize_cells(img, cells, out_path):
                     fontsize=10, ncol=3)  
     plt.gcf().set_size_inches(10, 10)
     plt.axis('off')
-    plt.savefig(out_path, bbox_inches='tight', dpi=150)
+    plt.savefig(out_path, bbox_inches='tight', dpi=150, format=fig_format, pil_kwargs=pil_kwargs)
     plt.close()
 
     return
 
+def structure_outputs(objects, tokens, class_thresholds, out_objects=False, out_cells=False,
+                      out_html=False, out_csv=False):
+    """
+    Post-process the structure model objects of one table into the requested output formats.
+    Needs no model, so it can run in another process.
+    """
+    out_formats = {}
+    if out_objects:
+        out_formats['objects'] = objects
+    if not (out_cells or out_html or out_csv):
+        return out_formats
+
+    # Further process the detected objects so they correspond to a consistent table 
+    tables_structure = objects_to_structures(objects, tokens, class_thresholds)
+
+    # Enumerate all table cells: grid cells and spanning cells
+    tables_cells = [structure_to_cells(structure, tokens)[0] for structure in tables_structure]
+    if out_cells:
+        out_formats['cells'] = tables_cells
+    if not (out_html or out_csv):
+        return out_formats
+
+    # Convert cells to HTML
+    if out_html:
+        tables_htmls = [cells_to_html(cells) for cells in tables_cells]
+        out_formats['html'] = tables_htmls
+
+    # Convert cells to CSV, including flattening multi-row column headers to a single row 
+    if out_csv:
+        tables_csvs = [cells_to_csv(cells) for cells in tables_cells]
+        out_formats['csv'] = tables_csvs
+
+    return out_formats
+
 class TableExtractionPipeline(object):
     def __init__(self, det_device=None, str_device=None,
                  det_model=None, str_model=None,
                  det_model_path=None, str_model_path=None,
-                 det_config_path=None, str_config_path=None):
-
+                 det_config_path=None, str_config_path=None,
+                 channels_last=False, autocast_dtype=None, num_threads=None, quantize=False,
+                 backend='torch', det_compile_batch_size=1, str_compile_batch_size=1, compile_step=160,
+                 warmup=True, det_early_exit=None, str_early_exit=None,
+                 det_token_pruning=None, str_token_pruning=None, crop_margins=False,
+                 cascade_size=None, cascade_score_margin=0.15, cascade_min_box_size=64):
+        """
+        Models loaded from checkpoints are prepared for inference with models.detr.optimize_for_inference
+        (frozen BatchNorm folded into the backbone convolutions, unused backbone outputs dropped).
+
+        CPU execution options (models always run in torch.inference_mode):
+        channels_last: convert the models to channels_last memory format, which suits the ResNet backbone
+                       convolutions on CPU
+        autocast_dtype: run the models under autocast with this dtype, e.g. torch.bfloat16
+        num_threads: number of intra-op threads torch uses. Default: torch's own choice.
+        quantize: apply dynamic int8 quantization to the transformer of fp32 checkpoints (see quantization.py).
+                  Quantized checkpoints are detected and loaded as they are. Quantized models run on CPU only.
+        backend: 'torch', or 'onnxruntime' to run ONNX models exported by scripts/export_onnx.py on CPU.
+                 With onnxruntime, det_model_path and str_model_path are the .onnx files and no config is needed.
+                 'inductor' (torch.compile) or 'torchscript' run compiled models on padded shape buckets,
+                 see compiled_backend.py. det/str_compile_batch_size are the batch sizes they are compiled for,
+                 compile_step the bucket granularity in pixels, and with warmup every bucket is compiled here
+                 instead of on first use.
+        det/str_early_exit: models.detr.EarlyExit policies that let the decoder of each model stop at the first
+                            layer whose predictions have converged. Its exit_counts collect per-layer statistics.
+                            Torch backend only.
+        det/str_token_pruning: models.detr.TokenPruning policies that leave feature locations over blank
+                               image areas out of the transformer of each model. Torch backend only.
+        crop_margins: crop every page to its content (find_content_bbox) before detection, and map the
+                      detected boxes back to page coordinates.
+        cascade_size: detect at this max size first, and re-run at the full detection size only the pages
+                      cascade_decision flags (cascade_score_margin, cascade_min_box_size). One record per
+                      page is appended to self.cascade_decisions. Compiled backends compile shape buckets
+                      for cascade_size too. Default: no cascade.
+        """
         self.det_device = det_device
         self.str_device = str_device
+        self.det_model = det_model
+        self.str_model = str_model
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+        self.crop_margins = crop_margins
+        self.cascade_size = cascade_size
+        self.cascade_score_margin = cascade_score_margin
+        self.cascade_min_box_size = cascade_min_box_size
+        self.cascade_transform = get_detection_transform(cascade_size) if not cascade_size is None else None
+        self.cascade_decisions = []
+        self.det_early_exit = det_early_exit if backend == 'torch' else None
+        self.str_early_exit = str_early_exit if backend == 'torch' else None
+        self.det_token_pruning = det_token_pruning if backend == 'torch' else None
+        self.str_token_pruning = str_token_pruning if backend == 'torch' else None
+        if not num_threads is None:
+            torch.set_num_threads(num_threads)
 
         self.det_class_name2idx = get_class_map('detection')
         self.det_class_idx2name = {v:k for k, v in self.det_class_name2idx.items()}
@@ -705,7 +1092,17 @@ class TableExtractionPipeline(object):
         self.str_class_idx2name = {v:k for k, v in self.str_class_name2idx.items()}
         self.str_class_thresholds = structure_class_thresholds
 
-        if not det_config_path is None:
+        if backend == 'onnxruntime':
+            if not det_model_path is None:
+                self.det_model = OnnxModel(det_model_path, num_threads=num_threads)
+                print("Detection model loaded with onnxruntime.")
+            if not str_model_path is None:
+                self.str_model = OnnxModel(str_model_path, num_threads=num_threads)
+                print("Structure model loaded with onnxruntime.")
+        elif backend != 'torch' and not backend in COMPILE_MODES:
+            raise ValueError(f'Unknown backend {backend}')
+
+        if backend != 'onnxruntime' and not det_config_path is None:
             with open(det_config_path, 'r', encoding="utf-8") as f:
                 det_config = json.load(f)
             det_args = type('Args', (object,), det_config)
@@ -714,22 +1111,27 @@ class TableExtractionPipeline(object):
             print("Detection model initialized.")
 
             if not det_model_path is None:
-                try:
-                    self.det_model.load_state_dict(torch.load(det_model_path,
-                                                        map_location=torch.device(det_device)),
-                                                        strict=False)
-                except:
-                    self.det_model.load_state_dict(torch.load(det_model_path,
-                                                        map_location=torch.device(det_device))['model_state_dict'],
-                                                        strict=False)
+                checkpoint = torch.load(det_model_path, map_location=torch.device(det_device))
+                if is_quantized_checkpoint(checkpoint):
+                    self.det_model = load_quantized_model(self.det_model, checkpoint)
+                else:
+                    try:
+                        self.det_model.load_state_dict(checkpoint, strict=False)
+                    except:
+                        self.det_model.load_state_dict(checkpoint['model_state_dict'], strict=False)
+                    if quantize:
+                        self.det_model = quantize_model(self.det_model)
 
                 self.det_model.to(det_device)
                 self.det_model.eval()
+                optimize_for_inference(self.det_model)
+                enable_early_exit(self.det_model, self.det_early_exit)
+                enable_token_pruning(self.det_model, self.det_token_pruning)
                 print("Detection model weights loaded.")
             else:
                 self.det_model = None
 
-        if not str_config_path is None:
+        if backend != 'onnxruntime' and not str_config_path is None:
             with open(str_config_path, 'r', encoding="utf-8") as f:
                 str_config = json.load(f)
             str_args = type('Args', (object,), str_config)
@@ -738,109 +1140,267 @@ class TableExtractionPipeline(object):
             print("Structure model initialized.")
 
             if not str_model_path is None:
-                try:
-                    self.str_model.load_state_dict(torch.load(str_model_path,
-                                                        map_location=torch.device(str_device)))
-                except:
-                    self.str_model.load_state_dict(torch.load(str_model_path,
-                                                        map_location=torch.device(str_device))['model_state_dict'])
+                checkpoint = torch.load(str_model_path, map_location=torch.device(str_device))
+                if is_quantized_checkpoint(checkpoint):
+                    self.str_model = load_quantized_model(self.str_model, checkpoint)
+                else:
+                    try:
+                        self.str_model.load_state_dict(checkpoint)
+                    except:
+                        self.str_model.load_state_dict(checkpoint['model_state_dict'])
+                    if quantize:
+                        self.str_model = quantize_model(self.str_model)
                 self.str_model.to(str_device)
                 self.str_model.eval()
+                optimize_for_inference(self.str_model)
+                enable_early_exit(self.str_model, self.str_early_exit)
+                enable_token_pruning(self.str_model, self.str_token_pruning)
                 print("Structure model weights loaded.")
             else:
                 self.str_model = None
+
+        if channels_last and backend != 'onnxruntime':
+            for model in (self.det_model, self.str_model):
+                if not model is None:
+                    model.to(memory_format=torch.channels_last)
+
+        self.warmup_stats = []
+        if backend in COMPILE_MODES:
+            if not self.det_model is None:
+                # cascade pages get buckets of their own, instead of being padded up to full-size ones
+                self.det_model = CompiledModel(self.det_model, mode=backend, max_size=detection_transform_size,
+                                               step=compile_step, batch_size=det_compile_batch_size,
+                                               extra_sizes=[cascade_size] if not cascade_size is None else [])
+            if not self.str_model is None:
+                self.str_model = CompiledModel(self.str_model, mode=backend, max_size=structure_transform_size,
+                                               step=compile_step, batch_size=str_compile_batch_size)
+            if warmup:
+                self.warmup()
         
         self.times = []
         self.detect_times = []
         self.recognize_times = []
 
 
+    def warmup(self):
+        """
+        Compile every shape bucket of the compiled models, and record the compile time (first run)
+        and the steady-state latency (second run) of each bucket in self.warmup_stats.
+        """
+        for name, model in (('detection', self.det_model), ('structure', self.str_model)):
+            if not isinstance(model, CompiledModel):
+                continue
+            for bucket in model.buckets:
+                img_tensors = [torch.zeros(3, *bucket)] * model.batch_size
+                latencies = []
+                for _ in range(2):
+                    cur_time = time.time()
+                    run_model(model, img_tensors, channels_last=self.channels_last,
+                              autocast_dtype=self.autocast_dtype)
+                    latencies.append(time.time() - cur_time)
+                self.warmup_stats.append({'model': name, 'bucket': bucket,
+                                          'compile_time': latencies[0], 'latency': latencies[1]})
+                print(f'Compiled {name} model for {bucket[0]}x{bucket[1]} in {latencies[0]:.1f}s, '
+                      f'steady-state latency {latencies[1]:.3f}s.')
+
+            stats = [elem for elem in self.warmup_stats if elem['model'] == name]
+            print(f'{name} model: {len(stats)} buckets compiled in {sum(elem["compile_time"] for elem in stats):.1f}s, '
+                  f'mean steady-state latency {np.mean([elem["latency"] for elem in stats]):.3f}s.')
+
     def __call__(self, page_image, page_tokens=None):
         return self.extract(self, page_image, page_tokens)
 
     def detect(self, img, tokens=None, out_objects=True, out_crops=False, crop_padding=10):
-        out_formats = {}
         if self.det_model is None:
             print("No detection model loaded.")
-            return out_formats
+            return {}
+
+        return self.detect_batch([img], [tokens], out_objects=out_objects, out_crops=out_crops,
+                                 crop_padding=crop_padding, batch_size=1)[0]
+
+    def detect_batch(self, imgs, tokens=None, out_objects=True, out_crops=False, crop_padding=10,
+                     batch_size=8, max_aspect_ratio_gap=0.1):
+        """
+        Detect tables on many pages at once. Pages are grouped by aspect ratio into batches of
+        at most batch_size, padded to the largest page of each batch and run through the detection
+        model together. With cascade_size set, all pages first run at that size and only the pages
+        cascade_decision flags run again at the full detection size.
+
+        imgs: list of PIL.Image
+        tokens: list of per-page tokens (only needed for out_crops), or None
+        output: list of per-page outputs in the same order as imgs, each like the output of detect
+        """
+        if self.det_model is None:
+            print("No detection model loaded.")
+            return [{} for _ in imgs]
+        if tokens is None:
+            tokens = [None] * len(imgs)
 
         cur_time = time.time()
-        # Transform the image how the model expects it
-        img_tensor = detection_transform(img)
-
-        # Run input image through the model
-        outputs = self.det_model([img_tensor.to(self.det_device)])
-
-        # Post-process detected objects, assign class labels
-        objects = outputs_to_objects(outputs, img.size, self.det_class_idx2name)
-        if out_objects:
-            out_formats['objects'] = objects
-        if not out_crops:
-            return out_formats
-
-        # Crop image and tokens for detected table
-        if out_crops:
-            tables_crops = objects_to_crops(img, tokens, objects, self.det_class_thresholds,
-                                            padding=crop_padding)
-            out_formats['crops'] = tables_crops
+        # Crop the page margins, so the content gets more of the detection resolution
+        content_bboxes = [find_content_bbox(img) if self.crop_margins else None for img in imgs]
+        model_imgs = [img if bbox is None else img.crop(bbox) for img, bbox in zip(imgs, content_bboxes)]
 
-        self.detect_times.append(time.time() - cur_time)
+        if self.cascade_transform is None:
+            page_objects = self.detect_objects(model_imgs, detection_transform, batch_size, max_aspect_ratio_gap)
+        else:
+            # cheap low-resolution pass first; only the pages it is unsure about run at full resolution
+            page_objects = self.detect_objects(model_imgs, self.cascade_transform, batch_size, max_aspect_ratio_gap)
+            low_res_time = (time.time() - cur_time) / len(imgs) if len(imgs) > 0 else 0
+            decisions = []
+            for img, objects in zip(model_imgs, page_objects):
+                reasons = cascade_decision(objects, img.size, self.det_class_thresholds, self.cascade_size,
+                                           score_margin=self.cascade_score_margin,
+                                           min_box_size=self.cascade_min_box_size)
+                decisions.append({'size': self.cascade_size if len(reasons) == 0 else detection_transform_size,
+                                  'reasons': reasons, 'low_res_objects': len(objects),
+                                  'low_res_time': low_res_time, 'full_res_time': 0.0})
+            rerun = [idx for idx, decision in enumerate(decisions) if len(decision['reasons']) > 0]
+            if len(rerun) > 0:
+                rerun_time = time.time()
+                rerun_objects = self.detect_objects([model_imgs[idx] for idx in rerun], detection_transform,
+                                                    batch_size, max_aspect_ratio_gap)
+                rerun_time = (time.time() - rerun_time) / len(rerun)
+                for idx, objects in zip(rerun, rerun_objects):
+                    page_objects[idx] = objects
+                    decisions[idx]['full_res_time'] = rerun_time
+            self.cascade_decisions.extend(decisions)
+
+        out_formats = []
+        for idx, (img, objects) in enumerate(zip(imgs, page_objects)):
+            if not content_bboxes[idx] is None:
+                objects = shift_objects(objects, content_bboxes[idx][0], content_bboxes[idx][1])
+            page_formats = {}
+            if out_objects:
+                page_formats['objects'] = objects
+
+            # Crop image and tokens for detected table
+            if out_crops:
+                page_formats['crops'] = objects_to_crops(img, tokens[idx], objects, self.det_class_thresholds,
+                                                         padding=crop_padding)
+            out_formats.append(page_formats)
+
+        # keep detect_times per page, spreading the batch time evenly
+        if len(imgs) > 0:
+            self.detect_times.extend([(time.time() - cur_time) / len(imgs)] * len(imgs))
 
         return out_formats
 
+    def detect_objects(self, imgs, transform, batch_size=8, max_aspect_ratio_gap=0.1):
+        """
+        Run the detection model on pages transformed with transform, batched by aspect ratio.
+
+        output: list of per-page detected objects, in the coordinates of each page in imgs
+        """
+        img_tensors = [transform(img) for img in imgs]
+        tensor_sizes = [(img_tensor.shape[2], img_tensor.shape[1]) for img_tensor in img_tensors]
+
+        page_objects = [None] * len(imgs)
+        for batch in batch_by_aspect_ratio(tensor_sizes, batch_size, max_aspect_ratio_gap=max_aspect_ratio_gap):
+            # Run the batch through the model; pages are padded and masked by nested_tensor_from_tensor_list
+            outputs = run_model(self.det_model, [img_tensors[idx] for idx in batch],
+                                channels_last=self.channels_last, autocast_dtype=self.autocast_dtype)
+            for idx, page_outputs in zip(batch, split_batch_outputs(outputs)):
+                # Post-process detected objects, assign class labels
+                page_objects[idx] = outputs_to_objects(page_outputs, imgs[idx].size, self.det_class_idx2name)
+        return page_objects
+
     def recognize(self, img, tokens=None, out_objects=False, out_cells=False,
                   out_html=False, out_csv=False):
-        out_formats = {}
         if self.str_model is None:
             print("No structure model loaded.")
-            return out_formats
+            return {}
+
+        return self.recognize_batch([img], [tokens], out_objects=out_objects, out_cells=out_cells,
+                                    out_html=out_html, out_csv=out_csv, batch_size=1)[0]
+
+    def recognize_batch(self, imgs, tokens=None, out_objects=False, out_cells=False,
+                        out_html=False, out_csv=False, batch_size=8, max_aspect_ratio_gap=0.1):
+        """
+        Recognize the structure of many table images at once. Tables are grouped by aspect ratio
+        into batches of at most batch_size and run through the structure model together;
+        post-processing into cells, HTML and CSV then runs per table.
+
+        imgs: list of PIL.Image
+        tokens: list of per-table tokens, or None
+        output: list of per-table outputs in the same order as imgs, each like the output of recognize
+        """
+        if self.str_model is None:
+            print("No structure model loaded.")
+            return [{} for _ in imgs]
 
         if not (out_objects or out_cells or out_html or out_csv):
             print("No output format specified")
-            return out_formats
+            return [{} for _ in imgs]
+        if tokens is None:
+            tokens = [None] * len(imgs)
 
         cur_time = time.time()
-        # Transform the image how the model expects it
-        img_tensor = structure_transform(img)
-
-        # Run input image through the model
-        outputs = self.str_model([img_tensor.to(self.str_device)])
-
-        # Post-process detected objects, assign class labels
-        objects = outputs_to_objects(outputs, img.size, self.str_class_idx2name)
-        if out_objects:
-            out_formats['objects'] = objects
-        if not (out_cells or out_html or out_csv):
-            return out_formats
-
-        # Further process the detected objects so they correspond to a consistent table 
-        tables_structure = objects_to_structures(objects, tokens, self.str_class_thresholds)
-
-        # Enumerate all table cells: grid cells and spanning cells
-        tables_cells = [structure_to_cells(structure, tokens)[0] for structure in tables_structure]
-        if out_cells:
-            out_formats['cells'] = tables_cells
-        if not (out_html or out_csv):
-            return out_formats
-
-        # Convert cells to HTML
-        if out_html:
-            tables_htmls = [cells_to_html(cells) for cells in tables_cells]
-            out_formats['html'] = tables_htmls
-
-        # Convert cells to CSV, including flattening multi-row column headers to a single row 
-        if out_csv:
-            tables_csvs = [cells_to_csv(cells) for cells in tables_cells]
-            out_formats['csv'] = tables_csvs
-        self.recognize_times.append(time.time() - cur_time)
+        objects_list = self.recognize_objects(imgs, batch_size=batch_size, max_aspect_ratio_gap=max_aspect_ratio_gap)
+
+        out_formats = [self.structure_outputs(objects, table_tokens, out_objects=out_objects, out_cells=out_cells,
+                                              out_html=out_html, out_csv=out_csv)
+                       for objects, table_tokens in zip(objects_list, tokens)]
+
+        # keep recognize_times per table, spreading the batch time evenly
+        if len(imgs) > 0:
+            self.recognize_times.extend([(time.time() - cur_time) / len(imgs)] * len(imgs))
 
         return out_formats
 
+    def recognize_objects(self, imgs, batch_size=8, max_aspect_ratio_gap=0.1):
+        """
+        Run the structure model on table images, batched by aspect ratio.
+
+        output: list of per-table detected objects, in the coordinates of each image in imgs
+        """
+        # Transform the images how the model expects them
+        img_tensors = [structure_transform(img) for img in imgs]
+        tensor_sizes = [(img_tensor.shape[2], img_tensor.shape[1]) for img_tensor in img_tensors]
+
+        objects_list = [None] * len(imgs)
+        for batch in batch_by_aspect_ratio(tensor_sizes, batch_size, max_aspect_ratio_gap=max_aspect_ratio_gap):
+            # Run the batch through the model
+            outputs = run_model(self.str_model, [img_tensors[idx] for idx in batch],
+                                channels_last=self.channels_last, autocast_dtype=self.autocast_dtype)
+
+            # Post-process detected objects, assign class labels
+            for idx, table_outputs in zip(batch, split_batch_outputs(outputs)):
+                objects_list[idx] = outputs_to_objects(table_outputs, imgs[idx].size, self.str_class_idx2name)
+        return objects_list
+
+    def structure_outputs(self, objects, tokens, out_objects=False, out_cells=False,
+                          out_html=False, out_csv=False):
+        return structure_outputs(objects, tokens, self.str_class_thresholds, out_objects=out_objects,
+                                 out_cells=out_cells, out_html=out_html, out_csv=out_csv)
+
+    def extract_detection(self, img, tokens=None, out_objects=True, crop_padding=10, pdf_page=None,
+                          structure_max_size=1000):
+        """
+        Detection half of extract: the detected objects (only if out_objects) and the table crops,
+        re-rendered from pdf_page if it is given.
+        """
+        detect_out = self.detect(img, tokens=tokens, out_objects=True, out_crops=pdf_page is None,
+                                 crop_padding=crop_padding)
+        if pdf_page is not None:
+            detect_out['crops'] = objects_to_pdf_crops(pdf_page, img.size, detect_out['objects'],
+                                                       self.det_class_thresholds, padding=crop_padding,
+                                                       max_size=structure_max_size)
+        if not out_objects:
+            del detect_out['objects']
+        return detect_out
+
     def extract(self, img, tokens=None, out_objects=True, out_crops=False, out_cells=False,
-                out_html=False, out_csv=False, crop_padding=10, args=None, img_file=None,):
+                out_html=False, out_csv=False, crop_padding=10, args=None, img_file=None,
+                pdf_page=None, structure_max_size=1000, structure_batch_size=1):
+        """
+        If pdf_page (the fitz.Page img was rendered from) is given, img only needs to be
+        at detection resolution: table crops are re-rendered from the PDF at structure_max_size.
+        If structure_batch_size > 1, the tables of the page are recognized with recognize_batch.
+        """
         cur_time = time.time()
-        detect_out = self.detect(img, tokens=tokens, out_objects=out_objects, out_crops=True,
-                                 crop_padding=crop_padding)
+        detect_out = self.extract_detection(img, tokens=tokens, out_objects=out_objects, crop_padding=crop_padding,
+                                            pdf_page=pdf_page, structure_max_size=structure_max_size)
         cropped_tables = detect_out['crops']
         # visualize detection results
         args_detect = deepcopy(args)
@@ -848,61 +1408,211 @@ class TableExtractionPipeline(object):
         for key, val in detect_out.items():
             output_result(key, val, args_detect, img, img_file)
 
-        extracted_tables = []
-        for table in cropped_tables:
-            img = table['image']
-            tokens = table['tokens']
-
-            extracted_table = self.recognize(img, tokens=tokens, out_objects=out_objects,
-                                       out_cells=out_cells, out_html=out_html, out_csv=out_csv)
-            extracted_table['image'] = img
-            extracted_table['tokens'] = tokens
-            extracted_tables.append(extracted_table)
+        if structure_batch_size > 1:
+            # all tables of the page go through the structure model in batches
+            extracted_tables = self.recognize_batch([table['image'] for table in cropped_tables],
+                                                    [table['tokens'] for table in cropped_tables],
+                                                    out_objects=out_objects, out_cells=out_cells,
+                                                    out_html=out_html, out_csv=out_csv,
+                                                    batch_size=structure_batch_size)
+        else:
+            extracted_tables = [self.recognize(table['image'], tokens=table['tokens'], out_objects=out_objects,
+                                               out_cells=out_cells, out_html=out_html, out_csv=out_csv)
+                                for table in cropped_tables]
+        for extracted_table, table in zip(extracted_tables, cropped_tables):
+            extracted_table['image'] = table['image']
+            extracted_table['tokens'] = table['tokens']
         self.times.append(time.time() - cur_time)
 
         return extracted_tables
 
 
+def write_output(args, out_file, data):
+    """
+    Write the bytes of one output file under args.out_dir, or into the artifact container
+    of its document if args.container is set (see artifact_container.py).
+
+    data: bytes, or a function returning them. If args.writer is set, the file is only handed to the
+          background writer (see artifact_writer.py), which calls the function in a writer thread.
+    """
+    out_path = os.path.join(args.out_dir, out_file)
+    container = getattr(args, 'container', None)
+    writer = getattr(args, 'writer', None)
+    if writer is not None:
+        writer.submit(out_path, data, container=container)
+        return
+    if callable(data):
+        data = data()
+    if container is not None:
+        container.write(out_path, data)
+    else:
+        with open(out_path, 'wb') as f:
+            f.write(data)
+
+def get_file_format(file_name):
+    return 'jpeg' if file_name.endswith('.jpg') else 'png'
+
+def get_png_options(args, file_name):
+    compress_level = getattr(args, 'png_compress_level', None)
+    if compress_level is None or get_file_format(file_name) != 'png':
+        return {}
+    return {'compress_level': compress_level}
+
+def image_to_bytes(img, file_name, **save_options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=get_file_format(file_name), **save_options)
+    return buffer.getvalue()
+
+def json_to_bytes(args, val):
+    if getattr(args, 'compact_json', False):
+        return json.dumps(val, separators=(',', ':')).encode('utf-8')
+    return json.dumps(val, indent=2).encode('utf-8')
+
+# pyplot keeps global state, so figures are rendered one at a time even with several writer threads
+figure_lock = threading.Lock()
+
+def figure_to_bytes(visualize, img, val, file_name, args):
+    def render():
+        buffer = io.BytesIO()
+        with figure_lock:
+            visualize(img, val, buffer, fig_format=get_file_format(file_name),
+                      pil_kwargs=get_png_options(args, file_name))
+        return buffer.getvalue()
+    return render
+
 def output_result(key, val, args, img, img_file):
+    """
+    JSON is encoded right away, so later changes to val do not show up in the files; images and
+    figures are encoded by the writer (in a writer thread if args.writer is set).
+    """
     if key == 'objects':
         if args.verbose:
             print(val)
         out_file = img_file.replace(".jpg", "_objects.json").replace(".png", "_objects.json")
-        with open(os.path.join(args.out_dir, out_file), 'w', encoding="utf-8") as out_file:
-            json.dump(val, out_file, indent=2)
+        write_output(args, out_file, json_to_bytes(args, val))
         if args.visualize:
             out_file = img_file.replace(".jpg", "_fig_tables.jpg").replace(".png", "_fig_tables.png")
-            out_path = os.path.join(args.out_dir, out_file)
-            visualize_detected_tables(img, val, out_path)
+            write_output(args, out_file, figure_to_bytes(visualize_detected_tables, img, deepcopy(val), out_file, args))
+    elif key == 'crops':
+        for idx, cropped_table in enumerate(val, start=1):
+            out_img_file = img_file.replace(".jpg", "_table_{}.jpg".format(idx)).replace(".png", "_table_{}.png".format(idx))
+            write_output(args, out_img_file, partial(image_to_bytes, cropped_table['image'], out_img_file,
+                                                     **get_png_options(args, out_img_file)))
+            out_words_file = out_img_file.replace(".jpg", "_words.json").replace(".png", "_words.json")
+            write_output(args, out_words_file, json_to_bytes(args, cropped_table['tokens']))
     elif not key == 'image' and not key == 'tokens':
         for idx, elem in enumerate(val, start=1):
-            if key == 'crops':
-                for idx, cropped_table in enumerate(val, start=1):
-                    out_img_file = img_file.replace(".jpg", "_table_{}.jpg".format(idx)).replace(".png", "_table_{}.png".format(idx))
-                    cropped_table['image'].save(os.path.join(args.out_dir, out_img_file))
-                    out_words_file = out_img_file.replace(".jpg", "_words.json").replace(".png", "_words.json")
-                    with open(os.path.join(args.out_dir, out_words_file), 'w', encoding="utf-8") as f:
-                        json.dump(cropped_table['tokens'], f, indent=2)
-            elif key == 'cells':
+            if key == 'cells':
                 out_file = img_file.replace(".jpg", "_cells.json").replace(".png", "_cells.json")
-                with open(os.path.join(args.out_dir, out_file), 'w', encoding="utf-8") as f:
-                    json.dump(elem, f, indent=2)
+                write_output(args, out_file, json_to_bytes(args, elem))
                 if args.verbose:
                     print(elem)
                 if args.visualize:
                     out_file = img_file.replace(".jpg", "_fig_cells.jpg").replace(".png", "_fig_cells.png")
-                    out_path = os.path.join(args.out_dir, out_file)
-                    visualize_cells(img, elem, out_path)
+                    write_output(args, out_file, figure_to_bytes(visualize_cells, img, deepcopy(elem), out_file, args))
             elif key == 'html':
                 out_file = img_file.replace(".jpg", ".html").replace(".png", ".html")
-                with open(os.path.join(args.out_dir, out_file), 'w', encoding="utf-8") as f:
-                    try:
-                        f.write(elem)
-                    except:
-                        f.write('')
+                try:
+                    data = elem.encode('utf-8')
+                except:
+                    data = b''
+                write_output(args, out_file, data)
                 if args.verbose:
                     print(elem)
 
+def load_image_and_tokens(args, img_file):
+    img_path = os.path.join(args.image_dir, img_file)
+    img = Image.open(img_path).convert('RGB')
+    print("Image loaded.")
+
+    if not args.words_dir is None:
+        tokens_path = find_words_file(args.words_dir, os.path.splitext(img_file)[0])
+        if not tokens_path is None:
+            tokens = load_words(tokens_path)
+        else:
+            print(f'No word file for {img_file} in {args.words_dir}. Ignore the content.')
+            tokens = []
+    else:
+        tokens = []
+    return img, tokens
+
+
+def tag_cascade_decisions(pipe, start, img_files):
+    """
+    Name the pages of the cascade decisions recorded since len(pipe.cascade_decisions) was start.
+    """
+    for decision, img_file in zip(pipe.cascade_decisions[start:], img_files):
+        decision['file'] = img_file
+
+def write_cascade_decisions(pipe, args):
+    """
+    Write one JSON line per detected page to out_dir/cascade_decisions.jsonl and print a summary.
+    """
+    decisions = pipe.cascade_decisions
+    with open(os.path.join(args.out_dir, 'cascade_decisions.jsonl'), 'w', encoding='utf-8') as f:
+        for decision in decisions:
+            f.write(json.dumps(decision) + '\n')
+    rerun = [decision for decision in decisions if len(decision['reasons']) > 0]
+    reason_counts = defaultdict(int)
+    for decision in rerun:
+        for reason in decision['reasons']:
+            reason_counts[reason] += 1
+    reasons = ', '.join(f'{reason}: {count}' for reason, count in sorted(reason_counts.items()))
+    print(f'Cascade detection: {len(decisions) - len(rerun)} of {len(decisions)} pages finished at '
+          f'{pipe.cascade_size}px, {len(rerun)} re-run at {detection_transform_size}px'
+          + (f' ({reasons}).' if len(rerun) > 0 else '.'))
+
+def detect_in_batches(pipe, args, img_files, pages_per_chunk=64):
+    """
+    Detect mode with batched detection: images are loaded pages_per_chunk at a time,
+    so pages of similar aspect ratio within a chunk can share a batch.
+    """
+    num_files = len(img_files)
+    for chunk_start in range(0, num_files, pages_per_chunk):
+        chunk_files, imgs, tokens = [], [], []
+        for count, img_file in enumerate(img_files[chunk_start:chunk_start + pages_per_chunk], start=chunk_start):
+            img_file = img_file.replace("output_", "")
+            print("({}/{})".format(count+1, num_files))
+            try:
+                img, page_tokens = load_image_and_tokens(args, img_file)
+            except Exception as e:
+                print(f'while processing {os.path.join(args.image_dir, img_file)}, got error: {e}.')
+                continue
+            chunk_files.append(img_file)
+            imgs.append(img)
+            tokens.append(page_tokens)
+
+        num_decisions = len(pipe.cascade_decisions)
+        try:
+            detected_pages = pipe.detect_batch(imgs, tokens, out_objects=args.objects, out_crops=args.crops,
+                                               crop_padding=args.crop_padding, batch_size=args.detection_batch_size)
+            tag_cascade_decisions(pipe, num_decisions, chunk_files)
+            pages = list(zip(chunk_files, imgs, detected_pages))
+        except Exception as e:
+            # one bad page fails the whole chunk; detect its pages one at a time so only that page is lost
+            print(f'while detecting a batch of {len(chunk_files)} pages, got error: {e}. Retrying page by page.')
+            del pipe.cascade_decisions[num_decisions:]
+            pages = []
+            for img_file, img, page_tokens in zip(chunk_files, imgs, tokens):
+                num_decisions = len(pipe.cascade_decisions)
+                try:
+                    detected_tables = pipe.detect(img, page_tokens, out_objects=args.objects, out_crops=args.crops,
+                                                  crop_padding=args.crop_padding)
+                except Exception as e:
+                    print(f'while processing {os.path.join(args.image_dir, img_file)}, got error: {e}.')
+                    del pipe.cascade_decisions[num_decisions:]
+                    continue
+                tag_cascade_decisions(pipe, num_decisions, [img_file])
+                pages.append((img_file, img, detected_tables))
+        print("Table(s) detected.")
+        for img_file, img, detected_tables in pages:
+            try:
+                for key, val in detected_tables.items():
+                    output_result(key, val, args, img, img_file)
+            except Exception as e:
+                print(f'while processing {os.path.join(args.image_dir, img_file)}, got error: {e}.')
+
+
 def main():
     args = get_args()
     print(args.__dict__)
@@ -910,9 +1620,28 @@ def main():
 
     if not args.out_dir is None and not os.path.exists(args.out_dir):
         os.makedirs(args.out_dir)
-    if args.mode == 'extract':
+    if args.mode == 'extract' and not args.artifact_container:
         os.makedirs(os.path.join(args.out_dir, 'detection'), exist_ok=True)
         os.makedirs(os.path.join(args.out_dir, 'structure'), exist_ok=True)
+    args.container = None
+    if args.artifact_container:
+        args.container = ContainerSet(args.out_dir, compress_level=args.zstd_level)
+    args.writer = None
+    if args.async_writer or args.fsync_every > 0:
+        args.writer = ArtifactWriter(workers=args.writer_threads if args.async_writer else 0,
+                                     fsync_every=args.fsync_every)
+
+    det_early_exit, str_early_exit = None, None
+    if args.early_exit:
+        early_exit_args = {'min_layers': args.early_exit_min_layers,
+                           'class_agreement': args.early_exit_class_agreement,
+                           'box_delta': args.early_exit_box_delta,
+                           'min_confidence': args.early_exit_min_confidence}
+        det_early_exit, str_early_exit = EarlyExit(**early_exit_args), EarlyExit(**early_exit_args)
+    det_token_pruning, str_token_pruning = None, None
+    if args.token_pruning:
+        token_pruning_args = {'blank_range': args.token_pruning_blank_range, 'margin': args.token_pruning_margin}
+        det_token_pruning, str_token_pruning = TokenPruning(**token_pruning_args), TokenPruning(**token_pruning_args)
 
     # Create inference pipeline
     print("Creating inference pipeline")
@@ -921,77 +1650,98 @@ def main():
                                    det_config_path=args.detection_config_path, 
                                    det_model_path=args.detection_model_path,
                                    str_config_path=args.structure_config_path, 
-                                   str_model_path=args.structure_model_path)
+                                   str_model_path=args.structure_model_path,
+                                   channels_last=args.channels_last,
+                                   autocast_dtype=torch.bfloat16 if args.bf16 else None,
+                                   num_threads=args.num_threads,
+                                   quantize=args.quantize,
+                                   backend=args.backend,
+                                   det_compile_batch_size=args.detection_batch_size,
+                                   str_compile_batch_size=args.structure_batch_size,
+                                   compile_step=args.compile_step,
+                                   det_early_exit=det_early_exit,
+                                   str_early_exit=str_early_exit,
+                                   det_token_pruning=det_token_pruning,
+                                   str_token_pruning=str_token_pruning,
+                                   crop_margins=args.crop_margins,
+                                   cascade_size=args.cascade_size,
+                                   cascade_score_margin=args.cascade_score_margin,
+                                   cascade_min_box_size=args.cascade_min_box_size)
 
     # Load images
     img_files = os.listdir(args.image_dir)
     num_files = len(img_files)
     random.shuffle(img_files)
 
-    for count, img_file in enumerate(img_files):
-        img_file = img_file.replace("output_", "")  # 파일 이름에서 'output_' 접두사 제거
-        print("({}/{})".format(count+1, num_files))
-        try:
-            img_path = os.path.join(args.image_dir, img_file)
-            img = Image.open(img_path).convert('RGB')
-            print("Image loaded.")
-
-            if not args.words_dir is None:
-                tokens_path = os.path.join(args.words_dir, img_file.replace(".jpg", "_words.json").replace(".png", "_words.json"))
-                if os.path.exists(tokens_path):
-                    with open(tokens_path, 'r', encoding="utf-8") as f:
-                        tokens = json.load(f)
-
-                        # Handle dictionary format
-                        if type(tokens) is dict and 'words' in tokens:
-                            tokens = tokens['words']
-
-                        # 'tokens' is a list of tokens
-                        # Need to be in a relative reading order
-                        # If no order is provided, use current order
-                        for idx, token in enumerate(tokens):
-                            if not 'span_num' in token:
-                                token['span_num'] = idx
-                            if not 'line_num' in token:
-                                token['line_num'] = 0
-                            if not 'block_num' in token:
-                                token['block_num'] = 0
-                else:
-                    print(f'No word file {tokens_path}. Ignore the content.')
-                    tokens = []
-            else:
-                tokens = []
-
-            if args.mode == 'recognize':
-                extracted_table = pipe.recognize(img, tokens, out_objects=args.objects, out_cells=args.cells,
-                                    out_html=args.html, out_csv=args.csv)
-                print("Table(s) recognized.")
-
-                for key, val in extracted_table.items():
-                    output_result(key, val, args, img, img_file)
-
-            if args.mode == 'detect':
-                detected_tables = pipe.detect(img, tokens, out_objects=args.objects, out_crops=args.crops)
-                print("Table(s) detected.")
-
-                for key, val in detected_tables.items():
-                    output_result(key, val, args, img, img_file)
+    if args.pipelined:
+        from pipeline_runner import PipelineRunner, print_summary
+        runner = PipelineRunner(pipe, args, loader_threads=args.loader_threads,
+                                postprocess_workers=args.postprocess_workers, queue_size=args.queue_size)
+        print_summary(runner.run(img_files))
+    elif args.mode == 'detect' and args.detection_batch_size > 1:
+        detect_in_batches(pipe, args, img_files)
+    else:
+        for count, img_file in enumerate(img_files):
+            img_file = img_file.replace("output_", "")  # 파일 이름에서 'output_' 접두사 제거
+            print("({}/{})".format(count+1, num_files))
+            try:
+                img, tokens = load_image_and_tokens(args, img_file)
 
-            if args.mode == 'extract':
-                extracted_tables = pipe.extract(img, tokens, out_objects=args.objects, out_cells=args.cells,
-                                                out_html=args.html, out_csv=args.csv,
-                                                crop_padding=args.crop_padding, args=args, img_file=img_file)
-                print("Table(s) extracted.")
+                if args.mode == 'recognize':
+                    extracted_table = pipe.recognize(img, tokens, out_objects=args.objects, out_cells=args.cells,
+                                        out_html=args.html, out_csv=args.csv)
+                    print("Table(s) recognized.")
 
-                args_structure = deepcopy(args)
-                args_structure.out_dir = os.path.join(args.out_dir, 'structure')
-                for table_idx, extracted_table in enumerate(extracted_tables, start=1):
                     for key, val in extracted_table.items():
-                        output_result(key, val, args_structure, extracted_table['image'],
-                                    img_file.replace('.jpg', '_{}.jpg'.format(table_idx)).replace('.png', '_{}.png'.format(table_idx)))
-        except Exception as e:
-            print(f'while processing {os.path.join(args.image_dir, img_file)}, got error: {e}.')
-            continue
+                        output_result(key, val, args, img, img_file)
+
+                num_decisions = len(pipe.cascade_decisions)
+                if args.mode == 'detect':
+                    detected_tables = pipe.detect(img, tokens, out_objects=args.objects, out_crops=args.crops)
+                    tag_cascade_decisions(pipe, num_decisions, [img_file])
+                    print("Table(s) detected.")
+
+                    for key, val in detected_tables.items():
+                        output_result(key, val, args, img, img_file)
+
+                if args.mode == 'extract':
+                    pdf_doc, pdf_page = None, None
+                    if not args.pdf_dir is None:
+                        pdf_doc, pdf_page = load_pdf_page(args.pdf_dir, img_file)
+                        if pdf_page is None:
+                            print(f'No source PDF page for {img_file}. Crop tables from the image.')
+                    extracted_tables = pipe.extract(img, tokens, out_objects=args.objects, out_cells=args.cells,
+                                                    out_html=args.html, out_csv=args.csv,
+                                                    crop_padding=args.crop_padding, args=args, img_file=img_file,
+                                                    pdf_page=pdf_page, structure_max_size=args.structure_max_size,
+                                                    structure_batch_size=args.structure_batch_size)
+                    tag_cascade_decisions(pipe, num_decisions, [img_file])
+                    if not pdf_doc is None:
+                        pdf_doc.close()
+                    print("Table(s) extracted.")
+
+                    args_structure = deepcopy(args)
+                    args_structure.out_dir = os.path.join(args.out_dir, 'structure')
+                    for table_idx, extracted_table in enumerate(extracted_tables, start=1):
+                        for key, val in extracted_table.items():
+                            output_result(key, val, args_structure, extracted_table['image'],
+                                        img_file.replace('.jpg', '_{}.jpg'.format(table_idx)).replace('.png', '_{}.png'.format(table_idx)))
+            except Exception as e:
+                print(f'while processing {os.path.join(args.image_dir, img_file)}, got error: {e}.')
+                continue
+
+    if not args.writer is None:
+        # every output has to be in its container before the containers are closed
+        args.writer.close()
+    if not args.container is None:
+        args.container.close()
+    if not args.writer is None:
+        summary = args.writer.summary()
+        print(f'Wrote {summary["files"]} files ({summary["bytes"] / 2**20:.1f} MiB, {summary["errors"]} errors) '
+              f'in {summary["write_time"]:.1f}s of {summary["workers"]} writer threads, '
+              f'{summary["fsyncs"]} fsync batches in {summary["fsync_time"]:.1f}s.')
+    if len(pipe.cascade_decisions) > 0:
+        write_cascade_decisions(pipe, args)
 
     if len(pipe.times) > 0:
         print(f'Total Avg time: {sum(pipe.times) / len(pipe.times)}s. Total of {len(pipe.times)} documents.')
@@ -999,6 +1749,19 @@ def main():
         print(f'Total Detection Avg time: {sum(pipe.detect_times) / len(pipe.detect_times)}s. Total of {len(pipe.detect_times)} documents.')
     if len(pipe.recognize_times) > 0:
         print(f'Total Recognize Avg time: {sum(pipe.recognize_times) / len(pipe.recognize_times)}s. Total of {len(pipe.recognize_times)} tables.')
+    for name, early_exit in (('Detection', pipe.det_early_exit), ('Structure', pipe.str_early_exit)):
+        if early_exit is None or sum(early_exit.exit_counts) == 0:
+            continue
+        summary = early_exit.summary()
+        exit_rates = ', '.join(f'{idx}: {rate:.1%}' for idx, rate in enumerate(summary['exit_rates'], start=1))
+        print(f'{name} decoder early exit: {summary["forwards"]} forwards, '
+              f'{summary["mean_layers"]:.2f} layers on average. Exits after layer {exit_rates}.')
+    for name, token_pruning in (('Detection', pipe.det_token_pruning), ('Structure', pipe.str_token_pruning)):
+        if token_pruning is None or token_pruning.tokens == 0:
+            continue
+        summary = token_pruning.summary()
+        print(f'{name} token pruning: {summary["kept_tokens"]} of {summary["tokens"]} tokens kept '
+              f'({summary["kept_rate"]:.1%}).')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+"""
+ONNX export of the DETR models and an onnxruntime model with the same call interface.
+
+The exported graph takes the padded image batch and its padding mask (the two halves of a NestedTensor)
+with dynamic batch, height and width axes, so pages of any size and padded batches run through one model:
+    inputs : images float32 [B, 3, H, W], mask bool [B, H, W] (True on padding)
+    outputs: pred_logits float32 [B, num_queries, num_classes + 1], pred_boxes float32 [B, num_queries, 4]
+"""
+import torch
+from torch import nn
+
+from util.misc import NestedTensor
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+INPUT_NAMES = ['images', 'mask']
+OUTPUT_NAMES = ['pred_logits', 'pred_boxes']
+DYNAMIC_AXES = {'images': {0: 'batch', 2: 'height', 3: 'width'},
+                'mask': {0: 'batch', 1: 'height', 2: 'width'},
+                'pred_logits': {0: 'batch'},
+                'pred_boxes': {0: 'batch'}}
+
+
+class ExportWrapper(nn.Module):
+    """
+    Take the NestedTensor as two plain tensors and return the outputs as a tuple, which ONNX export needs.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images, mask):
+        outputs = self.model(NestedTensor(images, mask))
+        return outputs['pred_logits'], outputs['pred_boxes']
+
+
+def export_onnx(model, path, max_size=800, opset_version=17):
+    """
+    Export a DETR model to ONNX. The example input is a max_size x max_size page;
+    height, width and batch size stay dynamic in the exported graph.
+    """
+    model = ExportWrapper(model.to('cpu').eval()).eval()
+    images = torch.zeros(1, 3, max_size, max_size)
+    mask = torch.zeros(1, max_size, max_size, dtype=torch.bool)
+    with torch.no_grad():
+        torch.onnx.export(model, (images, mask), path, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=DYNAMIC_AXES, opset_version=opset_version, do_constant_folding=True,
+                          dynamo=False)
+
+
+class OnnxModel(object):
+    """
+    Run an exported DETR model with onnxruntime on CPU.
+    Called with a NestedTensor like the torch model, and returns the same output dict of torch tensors.
+    """
+    def __init__(self, path, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required for the onnxruntime backend: pip install onnxruntime')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if not num_threads is None:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, samples):
+        pred_logits, pred_boxes = self.session.run(OUTPUT_NAMES, {'images': samples.tensors.cpu().numpy(),
+                                                                  'mask': samples.mask.cpu().numpy()})
+        return {'pred_logits': torch.from_numpy(pred_logits), 'pred_boxes': torch.from_numpy(pred_boxes)}
@@ -0,0 +1,113 @@
+"""
+In-memory table extraction from PDF files.
+
+Pages are rendered with PyMuPDF straight into memory at detection resolution, and detected tables
+are re-rendered from the PDF at structure resolution. Nothing is written to disk unless out_dir is given.
+
+    from inference import TableExtractionPipeline
+    from pdf_tables import extract_tables
+
+    pipe = TableExtractionPipeline(det_device='cpu', str_device='cpu', ...)
+    for page in extract_tables('sample.pdf', pipe):
+        for table in page['tables']:
+            print(page['page_number'], table['html'])
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import fitz
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'detr'))
+from inference import objects_to_pdf_crops, output_result
+from prescreen import table_likelihood
+
+
+def render_page(page, max_size=800):
+    """
+    page: fitz.Page
+    output: PIL.Image with its longest side at max_size pixels
+    """
+    zoom = max_size / max(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+
+def extract_tables(pdf_path, pipe, pages=None, detection_max_size=800, structure_max_size=1000,
+                   crop_padding=10, out_objects=True, out_cells=False, out_html=True, out_csv=False,
+                   prescreen_threshold=None, out_dir=None, structure_batch_size=1):
+    """
+    Detect and recognize the tables of a PDF, one page at a time.
+
+    pdf_path: path to the PDF file
+    pipe: inference.TableExtractionPipeline with detection and structure models loaded
+    pages: 1-based page numbers to process. Default: all pages.
+    prescreen_threshold: if given, pages whose prescreen.table_likelihood is below it skip detection
+    out_dir: if given, objects, crops, cells, html and csv are also written like inference.py does,
+             under out_dir/detection and out_dir/structure
+    structure_batch_size: if > 1, the tables of a page are run through the structure model in batches
+
+    output: iterator of per-page results
+        {'page_number': int,
+         'image': PIL.Image at detection resolution (None for prescreen skipped pages),
+         'prescreen_skipped': bool,
+         'objects': detected objects, bboxes in image pixels,
+         'tables': [{'image', 'tokens', 'objects', 'cells', 'html', 'csv'}, ...]}
+        table keys other than 'image' and 'tokens' are only present when requested.
+    """
+    file_prefix = Path(pdf_path).stem
+    if out_dir is not None:
+        args_detect = argparse.Namespace(out_dir=os.path.join(out_dir, 'detection'), verbose=False, visualize=False)
+        args_structure = argparse.Namespace(out_dir=os.path.join(out_dir, 'structure'), verbose=False, visualize=False)
+        os.makedirs(args_detect.out_dir, exist_ok=True)
+        os.makedirs(args_structure.out_dir, exist_ok=True)
+
+    with fitz.open(pdf_path) as doc:
+        page_numbers = range(1, doc.page_count + 1) if pages is None else pages
+        for page_number in page_numbers:
+            page = doc[page_number - 1]
+            result = {'page_number': page_number, 'image': None, 'prescreen_skipped': False,
+                      'objects': [], 'tables': []}
+
+            if prescreen_threshold is not None and table_likelihood(page) < prescreen_threshold:
+                result['prescreen_skipped'] = True
+                yield result
+                continue
+
+            img = render_page(page, max_size=detection_max_size)
+            result['image'] = img
+            objects = pipe.detect(img, out_objects=True, out_crops=False)['objects']
+            result['objects'] = objects
+            crops = objects_to_pdf_crops(page, img.size, objects, pipe.det_class_thresholds,
+                                         padding=crop_padding, max_size=structure_max_size)
+
+            img_file = f'{file_prefix}_page{page_number}.png'
+            if out_dir is not None:
+                detect_out = {'crops': crops}
+                if out_objects:
+                    detect_out['objects'] = objects
+                for key, val in detect_out.items():
+                    output_result(key, val, args_detect, img, img_file)
+
+            if structure_batch_size > 1:
+                tables = pipe.recognize_batch([crop['image'] for crop in crops], [crop['tokens'] for crop in crops],
+                                              out_objects=out_objects, out_cells=out_cells, out_html=out_html,
+                                              out_csv=out_csv, batch_size=structure_batch_size)
+            else:
+                tables = [pipe.recognize(crop['image'], tokens=crop['tokens'], out_objects=out_objects,
+                                         out_cells=out_cells, out_html=out_html, out_csv=out_csv)
+                          for crop in crops]
+
+            for table_idx, (crop, table) in enumerate(zip(crops, tables), start=1):
+                table['image'] = crop['image']
+                table['tokens'] = crop['tokens']
+                result['tables'].append(table)
+
+                if out_dir is not None:
+                    for key, val in table.items():
+                        output_result(key, val, args_structure, crop['image'],
+                                      img_file.replace('.png', '_{}.png'.format(table_idx)))
+
+            yield result
@@ -0,0 +1,329 @@
+"""
+Staged execution of inference.py, so the models never wait on file I/O or Python post-processing.
+
+    load (threads) -> model (batched forwards) -> post-process (process pool) -> write (thread)
+
+Loader threads decode page images and parse words files, the model stage runs the detection and
+structure forwards on whatever pages are ready (up to the batch sizes), a process pool turns structure
+objects into cells, HTML and CSV (objects_to_structures/structure_to_cells), and a single writer thread
+writes the outputs with output_result. The stages are connected by bounded queues, so a slow stage holds
+back the ones before it instead of buffering the whole input. With args.writer set (--async_writer),
+output_result only hands the files to the background writer of artifact_writer.py, which main flushes
+after the run.
+
+Every stage reports how busy it was (utilization: busy time / (wall time * workers)), how long it waited
+for input, and every queue its mean and max depth and how long producers were blocked on it being full.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+
+from inference import (load_image_and_tokens, load_pdf_page, objects_to_crops, objects_to_pdf_crops,
+                       output_result, structure_outputs, tag_cascade_decisions)
+
+# end of input marker passed through the queues
+DONE = None
+
+
+class StageStats(object):
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, busy_time=0.0, wait_time=0.0, items=0):
+        with self.lock:
+            self.busy_time += busy_time
+            self.wait_time += wait_time
+            self.items += items
+
+    def summary(self, wall_time):
+        return {'stage': self.name, 'workers': self.workers, 'items': self.items,
+                'busy_time': self.busy_time, 'wait_time': self.wait_time,
+                'utilization': self.busy_time / (wall_time * self.workers) if wall_time > 0 else 0.0}
+
+
+class StatsQueue(queue.Queue):
+    """
+    Bounded queue that samples its depth on every put and times producers blocked on it being full.
+    """
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.depth_sum = 0
+        self.depth_count = 0
+        self.max_depth = 0
+        self.blocked_time = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        tic = time.perf_counter()
+        super().put(item, block, timeout)
+        with self.mutex:
+            self.blocked_time += time.perf_counter() - tic
+            depth = self._qsize()
+            self.depth_sum += depth
+            self.depth_count += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        return {'queue': self.name, 'maxsize': self.maxsize, 'max_depth': self.max_depth,
+                'mean_depth': self.depth_sum / self.depth_count if self.depth_count > 0 else 0.0,
+                'blocked_time': self.blocked_time}
+
+
+def timed_structure_outputs(*args, **kwargs):
+    """
+    structure_outputs for the post-processing pool, also returning how long it took.
+    """
+    tic = time.perf_counter()
+    outputs = structure_outputs(*args, **kwargs)
+    return outputs, time.perf_counter() - tic
+
+
+class PipelineRunner(object):
+    """
+    Run inference.py's detect, recognize or extract mode over img_files with the stages above.
+
+    pipe: inference.TableExtractionPipeline
+    args: the parsed inference.py arguments
+    loader_threads: number of threads loading images and words
+    postprocess_workers: processes for structure post-processing; 0 runs it in one background thread
+    queue_size: capacity of the queues between stages, in pages (load) or output items (write)
+    """
+    def __init__(self, pipe, args, loader_threads=4, postprocess_workers=2, queue_size=16):
+        self.pipe = pipe
+        self.args = args
+        self.loader_threads = loader_threads
+        self.postprocess_workers = postprocess_workers
+        self.load_queue = StatsQueue('load -> model', queue_size)
+        self.write_queue = StatsQueue('model -> write', queue_size)
+        self.stats = {'load': StageStats('load', loader_threads),
+                      'model': StageStats('model'),
+                      'postprocess': StageStats('postprocess', max(postprocess_workers, 1)),
+                      'write': StageStats('write')}
+        self.wall_time = 0.0
+
+        self.args_detect, self.args_structure = args, args
+        if args.mode == 'extract':
+            self.args_detect = deepcopy(args)
+            self.args_detect.out_dir = os.path.join(args.out_dir, 'detection')
+            self.args_structure = deepcopy(args)
+            self.args_structure.out_dir = os.path.join(args.out_dir, 'structure')
+
+    def run(self, img_files):
+        start_time = time.perf_counter()
+        file_queue = queue.Queue()
+        for count, img_file in enumerate(img_files):
+            file_queue.put((count, img_file.replace("output_", "")))
+
+        loaders = [threading.Thread(target=self.load, args=(file_queue, len(img_files)), daemon=True)
+                   for _ in range(self.loader_threads)]
+        writer = threading.Thread(target=self.write, daemon=True)
+        for thread in loaders + [writer]:
+            thread.start()
+
+        if self.postprocess_workers > 0:
+            self.pool = ProcessPoolExecutor(self.postprocess_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.pool = ThreadPoolExecutor(1)
+        try:
+            self.run_model_stage()
+        finally:
+            self.write_queue.put(DONE)
+            writer.join()
+            self.pool.shutdown()
+        self.wall_time = time.perf_counter() - start_time
+        return self.summary()
+
+    def load(self, file_queue, num_files):
+        while True:
+            try:
+                count, img_file = file_queue.get_nowait()
+            except queue.Empty:
+                break
+            tic = time.perf_counter()
+            try:
+                img, tokens = load_image_and_tokens(self.args, img_file)
+            except Exception as e:
+                print(f'while processing {os.path.join(self.args.image_dir, img_file)}, got error: {e}.')
+                continue
+            print("({}/{})".format(count+1, num_files))
+            self.stats['load'].add(busy_time=time.perf_counter() - tic, items=1)
+            self.load_queue.put((img_file, img, tokens))
+        self.load_queue.put(DONE)
+
+    def next_batch(self, batch_size):
+        """
+        Block for the next loaded page, then take whatever else is ready, up to batch_size pages.
+        output: list of (img_file, img, tokens), empty once all loaders are done
+        """
+        batch = []
+        tic = time.perf_counter()
+        while len(batch) == 0 and self.loaders_done < self.loader_threads:
+            item = self.load_queue.get()
+            if item is DONE:
+                self.loaders_done += 1
+            else:
+                batch.append(item)
+        self.stats['model'].add(wait_time=time.perf_counter() - tic)
+        while len(batch) < batch_size and self.loaders_done < self.loader_threads:
+            try:
+                item = self.load_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is DONE:
+                self.loaders_done += 1
+            else:
+                batch.append(item)
+        return batch
+
+    def run_model_stage(self):
+        args = self.args
+        batch_size = args.structure_batch_size if args.mode == 'recognize' else args.detection_batch_size
+        self.loaders_done = 0
+        while True:
+            batch = self.next_batch(max(batch_size, 1))
+            if len(batch) == 0:
+                break
+            tic = time.perf_counter()
+            outputs = self.process(batch)
+            if outputs is None and len(batch) > 1:
+                # one bad page fails the whole batch; retry its pages one at a time so only that page is lost
+                outputs = []
+                for page in batch:
+                    outputs.extend(self.process([page]) or [])
+            self.stats['model'].add(busy_time=time.perf_counter() - tic, items=len(batch))
+            for output in outputs or []:
+                self.write_queue.put(output)
+
+    def process(self, batch):
+        """
+        output: the write items of the batch, or None if it failed (the error is printed)
+        """
+        num_decisions = len(self.pipe.cascade_decisions)
+        try:
+            if self.args.mode == 'detect':
+                return self.detect(batch)
+            elif self.args.mode == 'recognize':
+                return self.recognize(batch)
+            return self.extract(batch)
+        except Exception as e:
+            del self.pipe.cascade_decisions[num_decisions:]
+            img_files = ', '.join(img_file for img_file, _, _ in batch)
+            print(f'while processing {img_files}, got error: {e}.')
+            return None
+
+    def submit_structure_outputs(self, objects, tokens):
+        args = self.args
+        return self.pool.submit(timed_structure_outputs, objects, tokens, self.pipe.str_class_thresholds,
+                                out_objects=args.objects, out_cells=args.cells, out_html=args.html,
+                                out_csv=args.csv)
+
+    def detect(self, batch):
+        """
+        output: list of write items (args, img, img_file, outputs dict or future of one)
+        """
+        args = self.args
+        img_files, imgs, tokens = zip(*batch)
+        num_decisions = len(self.pipe.cascade_decisions)
+        detected_pages = self.pipe.detect_batch(list(imgs), list(tokens), out_objects=args.objects,
+                                                out_crops=args.crops, crop_padding=args.crop_padding,
+                                                batch_size=args.detection_batch_size)
+        tag_cascade_decisions(self.pipe, num_decisions, img_files)
+        return [(args, img, img_file, detected_tables)
+                for img_file, img, detected_tables in zip(img_files, imgs, detected_pages)]
+
+    def recognize(self, batch):
+        img_files, imgs, tokens = zip(*batch)
+        objects_list = self.pipe.recognize_objects(list(imgs), batch_size=self.args.structure_batch_size)
+        return [(self.args, img, img_file, self.submit_structure_outputs(objects, page_tokens))
+                for img_file, img, page_tokens, objects in zip(img_files, imgs, tokens, objects_list)]
+
+    def extract(self, batch):
+        """
+        Detect the tables of all pages of the batch, crop them, and recognize all crops together.
+        """
+        args = self.args
+        img_files, imgs, tokens = zip(*batch)
+        num_decisions = len(self.pipe.cascade_decisions)
+        detected_pages = self.pipe.detect_batch(list(imgs), list(tokens), out_objects=True,
+                                                crop_padding=args.crop_padding,
+                                                batch_size=args.detection_batch_size)
+        tag_cascade_decisions(self.pipe, num_decisions, img_files)
+
+        outputs, tables = [], []
+        for img_file, img, page_tokens, detect_out in zip(img_files, imgs, tokens, detected_pages):
+            pdf_doc, pdf_page = None, None
+            if not args.pdf_dir is None:
+                pdf_doc, pdf_page = load_pdf_page(args.pdf_dir, img_file)
+            if pdf_page is None:
+                detect_out['crops'] = objects_to_crops(img, page_tokens, detect_out['objects'],
+                                                       self.pipe.det_class_thresholds, padding=args.crop_padding)
+            else:
+                detect_out['crops'] = objects_to_pdf_crops(pdf_page, img.size, detect_out['objects'],
+                                                           self.pipe.det_class_thresholds,
+                                                           padding=args.crop_padding,
+                                                           max_size=args.structure_max_size)
+                pdf_doc.close()
+            if not args.objects:
+                del detect_out['objects']
+            outputs.append((self.args_detect, img, img_file, detect_out))
+            for table_idx, table in enumerate(detect_out['crops'], start=1):
+                table_file = img_file.replace('.jpg', '_{}.jpg'.format(table_idx)).replace(
+                    '.png', '_{}.png'.format(table_idx))
+                tables.append((table_file, table))
+
+        objects_list = self.pipe.recognize_objects([table['image'] for _, table in tables],
+                                                   batch_size=args.structure_batch_size)
+        for (table_file, table), objects in zip(tables, objects_list):
+            outputs.append((self.args_structure, table['image'], table_file,
+                            self.submit_structure_outputs(objects, table['tokens'])))
+        return outputs
+
+    def write(self):
+        while True:
+            tic = time.perf_counter()
+            item = self.write_queue.get()
+            wait_time = time.perf_counter() - tic
+            if item is DONE:
+                self.stats['write'].add(wait_time=wait_time)
+                break
+            out_args, img, img_file, outputs = item
+            try:
+                if not isinstance(outputs, dict):
+                    # waiting on the post-processing pool counts as waiting for input
+                    tic = time.perf_counter()
+                    outputs, postprocess_time = outputs.result()
+                    wait_time += time.perf_counter() - tic
+                    self.stats['postprocess'].add(busy_time=postprocess_time, items=1)
+                tic = time.perf_counter()
+                for key, val in outputs.items():
+                    output_result(key, val, out_args, img, img_file)
+                self.stats['write'].add(busy_time=time.perf_counter() - tic, wait_time=wait_time, items=1)
+            except Exception as e:
+                print(f'while writing the outputs of {img_file}, got error: {e}.')
+
+    def summary(self):
+        return {'wall_time': self.wall_time,
+                'stages': [stats.summary(self.wall_time) for stats in self.stats.values()],
+                'queues': [self.load_queue.summary(), self.write_queue.summary()]}
+
+
+def print_summary(summary):
+    print(f'Pipelined run: {summary["wall_time"]:.1f}s wall time.')
+    print(f'{"stage":>12} {"workers":>8} {"items":>6} {"busy":>9} {"waiting":>9} {"utilization":>12}')
+    for stage in summary['stages']:
+        print(f'{stage["stage"]:>12} {stage["workers"]:8d} {stage["items"]:6d} {stage["busy_time"]:8.1f}s '
+              f'{stage["wait_time"]:8.1f}s {stage["utilization"]:12.1%}')
+    print(f'{"queue":>16} {"size":>5} {"mean depth":>11} {"max depth":>10} {"producers blocked":>18}')
+    for stats in summary['queues']:
+        print(f'{stats["queue"]:>16} {stats["maxsize"]:5d} {stats["mean_depth"]:11.1f} {stats["max_depth"]:10d} '
+              f'{stats["blocked_time"]:17.1f}s')
@@ -0,0 +1,90 @@
+"""
+Cheap table prescreen from the PDF vector graphics and text layout.
+
+Pages scored below a threshold can skip rasterization and table detection entirely.
+The score is in [0, 1] and combines two signals:
+    * ruling lines: distinct positions of horizontal/vertical line segments (or thin rectangles), and of
+      box edges shared by several boxes as in a grid of cell boxes. A page border, header bar or logo box
+      alone is not a ruling, and fewer than 3 horizontal or 2 vertical positions score 0.
+    * aligned text columns: left edges of words shared by several text lines
+"""
+from collections import defaultdict
+
+
+def get_ruling_lines(page, min_length=10, max_thickness=2, tolerance=2, min_shared_boxes=2):
+    """
+    Thin lines and rectangles are rulings at their position. Edges of larger boxes only count at
+    positions min_shared_boxes boxes have an edge at, e.g. the row and column lines of a grid of cells.
+
+    page: fitz.Page
+    output: (number of distinct horizontal ruling positions, number of distinct vertical ruling positions)
+    """
+    horizontal = set()
+    vertical = set()
+    # position -> number of boxes with an edge there
+    box_rows = defaultdict(int)
+    box_cols = defaultdict(int)
+    for drawing in page.get_drawings():
+        for item in drawing['items']:
+            if item[0] == 'l':
+                p1, p2 = item[1], item[2]
+                x0, y0, x1, y1 = min(p1.x, p2.x), min(p1.y, p2.y), max(p1.x, p2.x), max(p1.y, p2.y)
+            elif item[0] == 're':
+                rect = item[1]
+                x0, x1 = min(rect.x0, rect.x1), max(rect.x0, rect.x1)
+                y0, y1 = min(rect.y0, rect.y1), max(rect.y0, rect.y1)
+            else:
+                continue
+            width, height = x1 - x0, y1 - y0
+            if height <= max_thickness and width >= min_length:
+                horizontal.add(int(round((y0 + y1) / 2 / tolerance)))
+            elif width <= max_thickness and height >= min_length:
+                vertical.add(int(round((x0 + x1) / 2 / tolerance)))
+            elif item[0] == 're' and width >= min_length and height >= min_length:
+                for y in {int(round(y0 / tolerance)), int(round(y1 / tolerance))}:
+                    box_rows[y] += 1
+                for x in {int(round(x0 / tolerance)), int(round(x1 / tolerance))}:
+                    box_cols[x] += 1
+    horizontal.update(y for y, count in box_rows.items() if count >= min_shared_boxes)
+    vertical.update(x for x, count in box_cols.items() if count >= min_shared_boxes)
+    return len(horizontal), len(vertical)
+
+
+def get_aligned_columns(page, tolerance=2, min_lines=3):
+    """
+    Count the x positions where at least min_lines different text lines have a column start.
+    A column start is the first word of a text line, or a word separated from the previous word
+    by a gap wider than the line height (ordinary word spacing in a paragraph is much narrower).
+
+    page: fitz.Page
+    output: number of aligned columns
+    """
+    words_by_line = defaultdict(list)
+    for word in page.get_text_words():
+        words_by_line[(word[5], word[6])].append(word)
+
+    lines_by_x = defaultdict(set)
+    for line_key, words in words_by_line.items():
+        words = sorted(words, key=lambda word: word[0])
+        previous = None
+        for word in words:
+            if previous is None or word[0] - previous[2] > word[3] - word[1]:
+                lines_by_x[int(round(word[0] / tolerance))].add(line_key)
+            previous = word
+    return sum(1 for lines in lines_by_x.values() if len(lines) >= min_lines)
+
+
+def table_likelihood(page):
+    """
+    page: fitz.Page
+    output: table likelihood score in [0, 1]
+    """
+    horizontal, vertical = get_ruling_lines(page)
+    ruling_score = 0.0
+    # a frame, an underline or a header bar has fewer rulings than the smallest ruled table
+    if horizontal >= 3 and vertical >= 2:
+        ruling_score = 0.5 * min(horizontal, 6) / 6 + 0.5 * min(vertical, 3) / 3
+    # 본문 단락은 왼쪽 여백 하나에만 정렬되므로 첫 번째 정렬 열은 제외
+    aligned_columns = get_aligned_columns(page)
+    column_score = min(max(aligned_columns - 1, 0), 3) / 3
+    return max(ruling_score, column_score)
@@ -0,0 +1,101 @@
+"""
+int8 quantization of the DETR models for CPU inference.
+
+    * dynamic: the nn.Linear layers of the transformer (feed-forward layers, which hold most
+      of its FLOPs) get int8 weights; activations are quantized on the fly, so no calibration is needed.
+      The attention input projections are fused into nn.MultiheadAttention and stay in float.
+    * static backbone (optional): the ResNet body is quantized with FX graph mode quantization,
+      calibrated on a few page images. FrozenBatchNorm2d is swapped for an equivalent nn.BatchNorm2d
+      first, so it is fused into the preceding convolution.
+
+Quantized models run on CPU only. A quantized checkpoint stores the quantization settings next to
+the state dict, so it can be rebuilt from the fp32 model config:
+    {'quantization': {'dynamic': True, 'static_backbone': bool, 'input_size': [h, w]}, 'model_state_dict': ...}
+"""
+import torch
+from torch import nn
+
+from models.backbone import FrozenBatchNorm2d
+
+
+def frozen_bn_to_batchnorm(module):
+    """
+    Replace every FrozenBatchNorm2d under module by an nn.BatchNorm2d in eval mode with the same statistics.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, FrozenBatchNorm2d):
+            bn = nn.BatchNorm2d(child.weight.shape[0])
+            bn.weight.data.copy_(child.weight)
+            bn.bias.data.copy_(child.bias)
+            bn.running_mean.copy_(child.running_mean)
+            bn.running_var.copy_(child.running_var)
+            bn.eval()
+            setattr(module, name, bn)
+        else:
+            frozen_bn_to_batchnorm(child)
+    return module
+
+
+def quantize_transformer(model):
+    model.transformer = torch.ao.quantization.quantize_dynamic(model.transformer, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantize_backbone(model, calibration_tensors, input_size=(800, 800)):
+    """
+    Statically quantize the ResNet body of model.backbone.
+
+    calibration_tensors: normalized image tensors [3, H, W] the activation ranges are observed on.
+                         An empty list only builds the quantized structure, e.g. to load a quantized state dict.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    backbone = model.backbone[0]
+    body = frozen_bn_to_batchnorm(backbone.body).eval()
+    example_inputs = (torch.zeros(1, 3, *input_size),)
+    prepared = prepare_fx(body, get_default_qconfig_mapping('x86'), example_inputs=example_inputs)
+    with torch.no_grad():
+        for img_tensor in calibration_tensors:
+            prepared(img_tensor.unsqueeze(0))
+    backbone.body = convert_fx(prepared)
+    return model
+
+
+def quantize_model(model, calibration_tensors=None, input_size=(800, 800)):
+    """
+    Quantize a fp32 DETR model in place for CPU inference.
+
+    calibration_tensors: if given, the backbone is also statically quantized, calibrated on these images
+    output: the quantized model
+    """
+    model.to('cpu').eval()
+    quantize_transformer(model)
+    static_backbone = calibration_tensors is not None
+    if static_backbone:
+        quantize_backbone(model, calibration_tensors, input_size=input_size)
+    model.quantization = {'dynamic': True, 'static_backbone': static_backbone, 'input_size': list(input_size)}
+    return model
+
+
+def save_quantized_model(model, path):
+    torch.save({'quantization': model.quantization, 'model_state_dict': model.state_dict()}, path)
+
+
+def is_quantized_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and 'quantization' in checkpoint
+
+
+def load_quantized_model(model, checkpoint):
+    """
+    Rebuild the quantized structure on a fp32 model built from the same config and load a quantized checkpoint.
+    """
+    settings = checkpoint['quantization']
+    model.to('cpu').eval()
+    if settings['dynamic']:
+        quantize_transformer(model)
+    if settings['static_backbone']:
+        quantize_backbone(model, [], input_size=settings['input_size'])
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.quantization = settings
+    return model
@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import torch
+from PIL import Image
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(src_dir, '..', 'detr'))
+from inference import TableExtractionPipeline
+from models import build_model
+
+
+class ExtractTester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # randomly initialized detection model, only the output keys are checked
+        config_path = os.path.join(src_dir, 'detection_config.json')
+        with open(config_path, 'r', encoding='utf-8') as f:
+            args = type('Args', (object,), json.load(f))
+        args.device = 'cpu'
+        model, _, _ = build_model(args)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, 'detection.pth')
+            torch.save(model.state_dict(), model_path)
+            cls.pipe = TableExtractionPipeline(det_device='cpu', det_config_path=config_path,
+                                               det_model_path=model_path)
+        cls.img = Image.new('RGB', (600, 800), 'white')
+
+    def test_extract_detection_objects(self):
+        detect_out = self.pipe.extract_detection(self.img, tokens=[], out_objects=True)
+        self.assertIn('objects', detect_out)
+        self.assertIn('crops', detect_out)
+
+    def test_extract_detection_without_objects(self):
+        detect_out = self.pipe.extract_detection(self.img, tokens=[], out_objects=False)
+        self.assertNotIn('objects', detect_out)
+        self.assertIn('crops', detect_out)
+
+
+if __name__ == '__main__':
+    unittest.main()
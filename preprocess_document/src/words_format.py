@@ -0,0 +1,161 @@
+"""
+Compact binary format for page words.
+
+A words file written by get_words_from_pdf is a list of
+{"bbox": [x1, y1, x2, y2], "text": str, "flags": int, "span_num": int, "line_num": int, "block_num": int}.
+The binary format stores the same words column by column, so it can be memory mapped and
+read without parsing:
+
+    header      : magic b'WRDS', version, number of words N, text buffer length T (4 x uint32)
+    bbox        : float32 [N, 4]
+    flags       : int32 [N]
+    span_num    : int32 [N]
+    line_num    : int32 [N]
+    block_num   : int32 [N]
+    text_offsets: int32 [N + 1], word i is text[text_offsets[i]:text_offsets[i+1]]
+    text        : UTF-8 bytes [T]
+
+Every section is a multiple of 4 bytes long except the trailing text buffer, so all arrays are aligned.
+"""
+import json
+import mmap
+import os
+
+import numpy as np
+
+MAGIC = b'WRDS'
+VERSION = 1
+HEADER_DTYPE = np.dtype('<u4')
+INT_FIELDS = ('flags', 'span_num', 'line_num', 'block_num')
+
+BINARY_SUFFIX = '_words.bin'
+JSON_SUFFIX = '_words.json'
+
+
+def write_words(path, words):
+    """
+    Write a list of word dicts to path in the binary words format.
+    Missing flags/span_num/line_num/block_num default the same way inference.py does.
+    """
+    num_words = len(words)
+    bbox = np.asarray([word['bbox'] for word in words], dtype='<f4').reshape(num_words, 4)
+    int_columns = {
+        'flags': [word.get('flags', 0) for word in words],
+        'span_num': [word.get('span_num', idx) for idx, word in enumerate(words)],
+        'line_num': [word.get('line_num', 0) for word in words],
+        'block_num': [word.get('block_num', 0) for word in words],
+    }
+    encoded = [word['text'].encode('utf-8') for word in words]
+    text_offsets = np.zeros(num_words + 1, dtype='<i4')
+    np.cumsum([len(text) for text in encoded], out=text_offsets[1:])
+    text = b''.join(encoded)
+
+    header = np.frombuffer(MAGIC, dtype=HEADER_DTYPE).tolist() + [VERSION, num_words, len(text)]
+    with open(path, 'wb') as f:
+        f.write(np.asarray(header, dtype=HEADER_DTYPE).tobytes())
+        f.write(bbox.tobytes())
+        for field in INT_FIELDS:
+            f.write(np.asarray(int_columns[field], dtype='<i4').tobytes())
+        f.write(text_offsets.tobytes())
+        f.write(text)
+
+
+class PageWords(object):
+    """
+    Memory mapped view of a binary words file.
+    The numpy arrays (bbox, flags, span_num, line_num, block_num, text_offsets) are read-only views into the file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f'{path} is empty')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = np.frombuffer(self._mmap, dtype=HEADER_DTYPE, count=4)
+        if header[:1].tobytes() != MAGIC:
+            raise ValueError(f'{path} is not a binary words file')
+        if header[1] != VERSION:
+            raise ValueError(f'Unsupported words file version {header[1]} in {path}')
+        num_words, text_length = int(header[2]), int(header[3])
+
+        offset = header.nbytes
+        self.bbox = np.frombuffer(self._mmap, dtype='<f4', count=num_words * 4, offset=offset).reshape(num_words, 4)
+        offset += self.bbox.nbytes
+        for field in INT_FIELDS:
+            column = np.frombuffer(self._mmap, dtype='<i4', count=num_words, offset=offset)
+            setattr(self, field, column)
+            offset += column.nbytes
+        self.text_offsets = np.frombuffer(self._mmap, dtype='<i4', count=num_words + 1, offset=offset)
+        offset += self.text_offsets.nbytes
+        self._text = memoryview(self._mmap)[offset:offset + text_length]
+
+    def __len__(self):
+        return len(self.bbox)
+
+    def text(self, idx):
+        return bytes(self._text[self.text_offsets[idx]:self.text_offsets[idx + 1]]).decode('utf-8')
+
+    def to_list(self):
+        """
+        output: a list of word dicts in the same layout as the JSON words files
+        """
+        texts = bytes(self._text).decode('utf-8')
+        # offsets are in bytes, so slice the encoded buffer unless the text is pure ASCII
+        if len(texts) != len(self._text):
+            texts = None
+        bboxes = self.bbox.tolist()
+        columns = [getattr(self, field).tolist() for field in INT_FIELDS]
+        offsets = self.text_offsets.tolist()
+        words = []
+        for idx in range(len(bboxes)):
+            word = {'bbox': bboxes[idx],
+                    'text': texts[offsets[idx]:offsets[idx + 1]] if texts is not None else self.text(idx)}
+            for field, column in zip(INT_FIELDS, columns):
+                word[field] = column[idx]
+            words.append(word)
+        return words
+
+
+def load_words(path):
+    """
+    Load a words file written as JSON or in the binary words format.
+
+    output: a list of {"bbox", "text", "flags", "span_num", "line_num", "block_num"} dicts,
+    in relative reading order
+    """
+    path = str(path)
+    if path.endswith('.bin'):
+        return PageWords(path).to_list()
+
+    with open(path, 'r', encoding="utf-8") as f:
+        tokens = json.load(f)
+
+    # Handle dictionary format
+    if type(tokens) is dict and 'words' in tokens:
+        tokens = tokens['words']
+
+    # 'tokens' is a list of tokens
+    # Need to be in a relative reading order
+    # If no order is provided, use current order
+    for idx, token in enumerate(tokens):
+        if not 'span_num' in token:
+            token['span_num'] = idx
+        if not 'line_num' in token:
+            token['line_num'] = 0
+        if not 'block_num' in token:
+            token['block_num'] = 0
+    return tokens
+
+
+def find_words_file(words_dir, stem):
+    """
+    Find the words file for an image or page stem, e.g. 'sample_page1'.
+    The binary format is preferred over JSON when both exist.
+
+    output: path of the words file, or None
+    """
+    for suffix in (BINARY_SUFFIX, JSON_SUFFIX):
+        path = os.path.join(words_dir, stem + suffix)
+        if os.path.exists(path):
+            return path
+    return None